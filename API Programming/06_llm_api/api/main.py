@@ -1,13 +1,33 @@
-from fastapi import FastAPI, HTTPException, Body
+import json
+from fastapi import FastAPI, HTTPException, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Dict, Any, Optional, List
+from contextlib import asynccontextmanager
 from llm.models import LLM
+from llm.clients import registry
+from llm.cache import cache
+from llm.batch import complete_batch, MAX_BATCH_SIZE
+from llm.resilience import CircuitOpenError, breaker_states
+from llm.router import router
+from llm.ratelimit import rate_limiter, caller_id
+from llm.coalesce import flights
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Provider clients are shared for the life of the process, close their pools on shutdown
+    await registry.aclose()
+    cache.close()
+
 
 app = FastAPI(
     title="LLM API",
     description="API for interacting with various LLM providers",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 
@@ -15,6 +35,16 @@ app = FastAPI(
 def index():
     return {'Welcome to llms api'}
 
+@app.middleware("http")
+async def identify_caller(request: Request, call_next):
+    # Rate limit queues take turns between callers, identified by X-Client-Id or their address
+    caller = request.headers.get("X-Client-Id") or (request.client.host if request.client else "anonymous")
+    token = caller_id.set(caller)
+    try:
+        return await call_next(request)
+    finally:
+        caller_id.reset(token)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -44,16 +74,41 @@ class CompletionResponse(BaseModel):
     model: str
     content: str
 
+class BatchCompletionItem(CompletionRequest):
+    model: str = Field(..., description="Name of the model for this completion")
+
+class BatchCompletionRequest(BaseModel):
+    items: List[BatchCompletionItem] = Field(..., description="Completions to run, possibly for different models")
+
+class BatchCompletionResult(BaseModel):
+    model: str
+    content: Optional[str] = None
+    status_code: int = 200
+    error: Optional[str] = None
+
 @app.get("/models", response_model=List[str])
 async def list_models():
     return LLM.all_model_names()
 
 @app.post("/completion/{model_name}", response_model=CompletionResponse)
 async def create_completion(model_name: str, request: CompletionRequest):
+    """
+    model_name can also be a routing group (see /routes), answered by its fastest healthy member
+    """
     try:
+        if router.is_group(model_name):
+            model_name, response = await router.complete(
+                model_name,
+                system_prompt=request.system_prompt,
+                user_prompt=request.user_prompt,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature
+            )
+            return CompletionResponse(model=model_name, content=response)
+
         llm = LLM.for_model_name(model_name, temperature=request.temperature)
         
-        response = llm.send(
+        response = await llm.acomplete(
             system_prompt=request.system_prompt,
             user_prompt=request.user_prompt,
             max_tokens=request.max_tokens
@@ -61,25 +116,115 @@ async def create_completion(model_name: str, request: CompletionRequest):
         
         return CompletionResponse(model=model_name, content=response)
     except KeyError:
-        available_models = LLM.all_model_names()
-        raise HTTPException(
-            status_code=404, 
-            detail=f"Model '{model_name}' not found. Available models: {', '.join(available_models)}"
-        )
+        raise model_not_found(model_name)
+    except CircuitOpenError as e:
+        raise provider_unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.post("/completions/batch", response_model=List[BatchCompletionResult])
+async def create_batch_completion(request: BatchCompletionRequest):
+    """
+    Run many completions concurrently, with at most LLM_PROVIDER_CONCURRENCY in flight per provider
+    Results come back in input order; a failed item records its error instead of failing the batch
+    """
+    if len(request.items) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {MAX_BATCH_SIZE} items")
+
+    responses = await complete_batch([item.model_dump() for item in request.items])
+
+    results = []
+    for item, response in zip(request.items, responses):
+        if isinstance(response, KeyError):
+            results.append(BatchCompletionResult(model=item.model, status_code=404, error=model_not_found(item.model).detail))
+        elif isinstance(response, CircuitOpenError):
+            results.append(BatchCompletionResult(model=item.model, status_code=503, error=str(response)))
+        elif isinstance(response, Exception):
+            results.append(BatchCompletionResult(model=item.model, status_code=500, error=str(response)))
+        else:
+            results.append(BatchCompletionResult(model=item.model, content=response))
+    return results
+
+
+def model_not_found(model_name: str) -> HTTPException:
+    available_models = LLM.all_model_names()
+    return HTTPException(
+        status_code=404, 
+        detail=f"Model '{model_name}' not found. Available models: {', '.join(available_models)}"
+    )
+
+
+def provider_unavailable(error: CircuitOpenError) -> HTTPException:
+    # Tell clients when to come back, rather than have them retry into an open breaker
+    return HTTPException(
+        status_code=503,
+        detail=str(error),
+        headers={"Retry-After": str(max(1, round(error.retry_after)))}
+    )
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+@app.post("/completion/{model_name}/stream")
+async def stream_completion(model_name: str, request: CompletionRequest):
+    """
+    Server-Sent Events version of /completion/{model_name}
+    Sends one data event per text chunk as the model produces it, then a "done" event,
+    or an "error" event if the provider fails part way through
+    A routing group streams from its best-ranked member, named in every event; once text has been
+    sent a stream can't fall over to another member
+    """
+    try:
+        if router.is_group(model_name):
+            model_name = router.ranked(model_name)[0]
+        llm = LLM.for_model_name(model_name, temperature=request.temperature)
+    except (KeyError, IndexError):
+        raise model_not_found(model_name)
+
+    async def events():
+        try:
+            async for chunk in llm.aresilient_stream(
+                system_prompt=request.system_prompt,
+                user_prompt=request.user_prompt,
+                max_tokens=request.max_tokens
+            ):
+                yield sse_event({"model": model_name, "content": chunk})
+            yield sse_event({"model": model_name}, event="done")
+        except Exception as e:
+            yield sse_event({"detail": str(e)}, event="error")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return cache.stats()
+
+@app.get("/routes")
+async def list_routes():
+    return router.stats()
+
+@app.get("/ratelimits")
+async def ratelimit_stats():
+    return rate_limiter.stats()
+
+@app.get("/coalesce/stats")
+async def coalesce_stats():
+    return flights.stats()
+
+@app.get("/providers/health")
+async def provider_health():
+    return breaker_states()
+
 @app.get("/providers")
 async def list_providers():
-    providers = {}
-    model_map = LLM.model_map()
-    
-    for model_name, llm_class in model_map.items():
-        provider = llm_class.__name__
-        if provider not in providers:
-            providers[provider] = []
-        providers[provider].append(model_name)
-    
-    return providers
+    return LLM.providers()
 
 
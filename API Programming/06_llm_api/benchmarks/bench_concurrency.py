@@ -0,0 +1,106 @@
+"""
+Concurrency benchmark for /completion/{model_name} against the local fake provider.
+
+Compares the old behaviour (blocking llm.send() inside the async endpoint) with the
+async path (await llm.asend()), both on one shared LLM instance, and then measures the
+endpoint end to end with a unique prompt per request. A last, separate phase sends identical
+prompts to show request coalescing. Run from the 06_llm_api folder:
+
+    python -m benchmarks.bench_concurrency --requests 200
+"""
+
+import argparse
+import asyncio
+import time
+import uuid
+from typing import Tuple
+
+import httpx
+
+from benchmarks.fake_provider import start_in_background
+from llm.clients import registry
+
+MODEL_NAME = "gpt-4o-mini"
+PAYLOAD = {"system_prompt": "You are a benchmark", "user_prompt": "ping", "max_tokens": 16, "temperature": 0}
+
+
+async def blocking_endpoint(llm):
+    # What create_completion used to do: a sync call inside an async function
+    return llm.send(PAYLOAD["system_prompt"], PAYLOAD["user_prompt"], PAYLOAD["max_tokens"])
+
+
+async def run_blocking(count: int) -> float:
+    from llm.models import LLM
+
+    llm = LLM.for_model_name(MODEL_NAME)
+    start = time.perf_counter()
+    await asyncio.gather(*[blocking_endpoint(llm) for _ in range(count)])
+    return time.perf_counter() - start
+
+
+async def run_asend(count: int) -> float:
+    from llm.models import LLM
+
+    llm = LLM.for_model_name(MODEL_NAME)
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[llm.asend(PAYLOAD["system_prompt"], PAYLOAD["user_prompt"], PAYLOAD["max_tokens"]) for _ in range(count)]
+    )
+    return time.perf_counter() - start
+
+
+async def run_endpoint(count: int, identical: bool = False) -> Tuple[float, int]:
+    """
+    :param identical: send the same prompt every time, which coalescing answers with one upstream call;
+    otherwise every request gets its own prompt, so each one really reaches the provider
+    :return: the elapsed seconds, and how many upstream calls the requests made
+    """
+    from api.main import app
+    from llm.coalesce import flights
+
+    payloads = [PAYLOAD if identical else dict(PAYLOAD, user_prompt=f"ping {uuid.uuid4().hex}") for _ in range(count)]
+    upstream_before = flights.stats()["upstream_calls"]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://api", timeout=60) as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *[client.post(f"/completion/{MODEL_NAME}", json=payload) for payload in payloads]
+        )
+        elapsed = time.perf_counter() - start
+
+    failed = [r for r in responses if r.status_code != 200]
+    if failed:
+        raise RuntimeError(f"{len(failed)} requests failed, first: {failed[0].text}")
+    return elapsed, flights.stats()["upstream_calls"] - upstream_before
+
+
+def report(label: str, count: int, elapsed: float) -> None:
+    print(f"{label:<22} {count:>5} requests in {elapsed:7.2f}s  ->  {count / elapsed:8.1f} req/s")
+
+
+async def run_all(args) -> None:
+    report("blocking send()", args.blocking_requests, await run_blocking(args.blocking_requests))
+    report("await asend()", args.requests, await run_asend(args.requests))
+    elapsed, _ = await run_endpoint(args.requests)
+    report("POST /completion", args.requests, elapsed)
+    # identical temperature-0 prompts share one upstream call, so this measures coalescing, not the provider
+    elapsed, upstream = await run_endpoint(args.requests, identical=True)
+    report("  coalesced, identical", args.requests, elapsed)
+    print(f"{'':<22} {upstream:>5} upstream calls for {args.requests} identical requests")
+    await registry.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--blocking-requests", type=int, default=20,
+                        help="the blocking path is serial, so keep this small")
+    args = parser.parse_args()
+
+    start_in_background()
+
+    asyncio.run(run_all(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+A local stand-in for an OpenAI-compatible provider, used by the benchmarks.
+
+It answers /v1/chat/completions after a fixed delay, so we can measure how many completions
+the API keeps in flight without spending tokens or depending on the network.
+With "stream": true it sends the answer word by word as OpenAI-style SSE chunks.
+FAILURE_RATE makes that fraction of requests fail with FAILURE_STATUS, to exercise retries.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY_SECONDS = float(os.getenv("FAKE_PROVIDER_LATENCY", "0.2"))
+CHUNK_SECONDS = float(os.getenv("FAKE_PROVIDER_CHUNK_LATENCY", "0.02"))
+FAILURE_RATE = float(os.getenv("FAKE_PROVIDER_FAILURE_RATE", "0"))
+FAILURE_STATUS = int(os.getenv("FAKE_PROVIDER_FAILURE_STATUS", "503"))
+
+app = FastAPI(title="Fake LLM provider")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    user_prompt = body["messages"][-1]["content"]
+    if random.random() < FAILURE_RATE:
+        return JSONResponse(
+            {"error": {"message": "fake provider failure", "type": "server_error"}},
+            status_code=FAILURE_STATUS,
+            headers={"Retry-After": "0.1"},
+        )
+    if body.get("stream"):
+        return StreamingResponse(stream_chunks(body["model"], f"echo: {user_prompt}"), media_type="text/event-stream")
+
+    await asyncio.sleep(LATENCY_SECONDS)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": f"echo: {user_prompt}"},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+async def stream_chunks(model: str, content: str):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    # time to first token is a fraction of the full latency, as with a real provider
+    await asyncio.sleep(LATENCY_SECONDS / 4)
+    for word in content.split(" "):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(CHUNK_SECONDS)
+    yield "data: [DONE]\n\n"
+
+
+def start_in_background(host: str = "127.0.0.1", port: int = 8765) -> str:
+    """
+    Run the fake provider in a daemon thread and point the OpenAI SDK at it
+    :return: the base url of the fake provider
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    base_url = f"http://{host}:{port}/v1"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "fake-key")
+    return base_url
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=8765)
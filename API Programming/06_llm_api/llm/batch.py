@@ -0,0 +1,51 @@
+import os
+import asyncio
+from typing import Dict, List, Union
+from llm.models import LLM
+from llm.router import router
+
+
+class ProviderLimiter:
+    """
+    Caps how many completions are in flight to each provider at once, across every batch
+    Extra work waits for a slot, which is the server's backpressure on large batches
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def for_provider(self, provider: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(provider)
+        if semaphore is None:
+            semaphore = self._semaphores[provider] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+
+limiter = ProviderLimiter(int(os.getenv("LLM_PROVIDER_CONCURRENCY", 16)))
+MAX_BATCH_SIZE = int(os.getenv("LLM_MAX_BATCH_SIZE", 256))
+
+
+async def complete_one(model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float) -> str:
+    """
+    Run one completion, waiting for a free slot with its provider first
+    model can also be a routing group, in which case each member tried waits for a slot with its own provider
+    :return: the response from the LLM
+    """
+    if router.is_group(model):
+        _, content = await router.complete(
+            model, system_prompt, user_prompt, max_tokens, temperature, slot_for=limiter.for_provider
+        )
+        return content
+    llm = LLM.for_model_name(model, temperature=temperature)
+    async with limiter.for_provider(type(llm).__name__):
+        return await llm.acomplete(system_prompt, user_prompt, max_tokens)
+
+
+async def complete_batch(items: List[dict]) -> List[Union[str, Exception]]:
+    """
+    Run a batch of completions concurrently, possibly against different models
+    :param items: keyword arguments for complete_one(), one dict per completion
+    :return: for each item in input order, the response or the exception it raised
+    """
+    return await asyncio.gather(*[complete_one(**item) for item in items], return_exceptions=True)
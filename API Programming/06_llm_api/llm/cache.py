@@ -0,0 +1,232 @@
+import os
+import json
+import asyncio
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+def request_key(model_name: str, system_prompt: str, user_prompt: str, temperature: float, max_tokens: int) -> str:
+    """
+    :return: a digest that is the same for identical completion requests
+    """
+    payload = json.dumps([model_name, system_prompt, user_prompt, float(temperature), int(max_tokens)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    A cache of completions, keyed on model, prompts, temperature and max_tokens
+    An in-memory LRU tier sits in front of an optional SQLite tier that survives restarts,
+    and both tiers expire entries after ttl_seconds.
+    Only requests at or below max_temperature are cached, since above that the caller
+    expects a different answer each time
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600,
+        db_path: Optional[str] = None,
+        max_disk_entries: int = 100_000,
+        max_temperature: float = 0.0,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.max_temperature = max_temperature
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # _lock guards the memory tier and the counters, _db_lock the SQLite connection, so an event
+        # loop checking the memory tier never waits on disk I/O running in a worker thread
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._puts_since_prune = 0
+        # accessed_at of rows read from disk since the last write, saved with the next put
+        self._accessed: Dict[str, float] = {}
+        self.connection: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._connect(db_path)
+
+    @classmethod
+    def from_env(cls) -> "CompletionCache":
+        """
+        Configure from LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL, LLM_CACHE_PATH (enables the SQLite tier),
+        LLM_CACHE_MAX_DISK_ENTRIES and LLM_CACHE_MAX_TEMPERATURE
+        """
+        return cls(
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024)),
+            ttl_seconds=float(os.getenv("LLM_CACHE_TTL", 3600)),
+            db_path=os.getenv("LLM_CACHE_PATH"),
+            max_disk_entries=int(os.getenv("LLM_CACHE_MAX_DISK_ENTRIES", 100_000)),
+            max_temperature=float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", 0.0)),
+        )
+
+    def _connect(self, db_path: str) -> None:
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, content TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions(accessed_at)")
+        self.connection.commit()
+
+    def key(self, model_name: str, system_prompt: str, user_prompt: str, temperature: float,
+            max_tokens: int) -> Optional[str]:
+        """
+        :return: the cache key for this request, or None if it should not be cached
+        """
+        if temperature > self.max_temperature:
+            return None
+        return request_key(model_name, system_prompt, user_prompt, temperature, max_tokens)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :return: the cached completion, or None on a miss
+        """
+        content = self._get_memory(key)
+        if content is None and self.connection is not None:
+            content = self._get_disk(key)
+        if content is None:
+            with self._lock:
+                self.misses += 1
+        return content
+
+    async def aget(self, key: str) -> Optional[str]:
+        """
+        get() for async callers: the memory tier is checked inline, the SQLite tier in a worker thread
+        so a slow disk never stalls the event loop
+        """
+        content = self._get_memory(key)
+        if content is None and self.connection is not None:
+            content = await asyncio.to_thread(self._get_disk, key)
+        if content is None:
+            with self._lock:
+                self.misses += 1
+        return content
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            content, expires_at = entry
+            if expires_at <= now:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return content
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._db_lock:
+            if self.connection is None:
+                return None
+            row = self.connection.execute(
+                "SELECT content, expires_at FROM completions WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            # no write on the read path; the access time goes out with the next put
+            self._accessed[key] = now
+        with self._lock:
+            self._remember(key, row[0], row[1])
+            self.disk_hits += 1
+        return row[0]
+
+    def put(self, key: str, content: str) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._remember(key, content, expires_at)
+        if self.connection is not None:
+            self._put_disk(key, content, expires_at)
+
+    async def aput(self, key: str, content: str) -> None:
+        """
+        put() for async callers, writing the SQLite tier in a worker thread
+        """
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._remember(key, content, expires_at)
+        if self.connection is not None:
+            await asyncio.to_thread(self._put_disk, key, content, expires_at)
+
+    def _put_disk(self, key: str, content: str, expires_at: float) -> None:
+        now = time.time()
+        with self._db_lock:
+            if self.connection is None:
+                return
+            self._save_accessed()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completions(key, content, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, content, expires_at, now),
+            )
+            self._puts_since_prune += 1
+            if self._puts_since_prune >= 256:
+                self._prune_disk(now)
+            self.connection.commit()
+
+    def _save_accessed(self) -> None:
+        # called with _db_lock held, inside the caller's write transaction
+        if self._accessed:
+            self.connection.executemany(
+                "UPDATE completions SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def _remember(self, key: str, content: str, expires_at: float) -> None:
+        self._memory[key] = (content, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _prune_disk(self, now: float) -> None:
+        # Drop expired rows, then the least recently used rows beyond max_disk_entries
+        self._puts_since_prune = 0
+        self.connection.execute("DELETE FROM completions WHERE expires_at <= ?", (now,))
+        self.connection.execute(
+            "DELETE FROM completions WHERE key IN "
+            "(SELECT key FROM completions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_enabled": self.connection is not None,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        with self._db_lock:
+            if self.connection is not None:
+                self._accessed.clear()
+                self.connection.execute("DELETE FROM completions")
+                self.connection.commit()
+
+    def close(self) -> None:
+        with self._db_lock:
+            if self.connection is not None:
+                self._save_accessed()
+                self.connection.commit()
+                self.connection.close()
+                self.connection = None
+
+
+cache = CompletionCache.from_env()
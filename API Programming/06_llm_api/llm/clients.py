@@ -0,0 +1,100 @@
+import os
+import asyncio
+import inspect
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Tuple
+
+import httpx
+
+
+@dataclass(frozen=True)
+class PoolSettings:
+    """
+    Connection pool sizes shared by every provider client
+    Override with LLM_MAX_CONNECTIONS, LLM_MAX_KEEPALIVE_CONNECTIONS and LLM_KEEPALIVE_EXPIRY
+    """
+
+    max_connections: int = 1000
+    max_keepalive_connections: int = 100
+    keepalive_expiry: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "PoolSettings":
+        return cls(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", cls.max_connections)),
+            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", cls.max_keepalive_connections)),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", cls.keepalive_expiry)),
+        )
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+
+class ClientRegistry:
+    """
+    A process-wide registry of provider SDK clients
+    Each client is built once per (provider, settings) and then reused, so its keep-alive
+    connection pool stays warm across requests instead of paying connection setup every call
+    """
+
+    def __init__(self, pool_settings: PoolSettings = None):
+        self.pool_settings = pool_settings or PoolSettings.from_env()
+        self._clients: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider: str, factory: Callable[..., Any], **settings) -> Any:
+        """
+        Return the shared client for this provider and settings, building it on first use
+        :param provider: A name for the kind of client, such as "openai" or "openai-async"
+        :param factory: Called as factory(pool_settings, **settings) to build the client
+        :param settings: Anything that makes a client different, such as a model name or base url
+        :return: the shared client
+        """
+        key = (provider, self.pool_settings, tuple(sorted(settings.items())))
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = factory(self.pool_settings, **settings)
+                    self._clients[key] = client
+        return client
+
+    def configure(self, pool_settings: PoolSettings) -> None:
+        """
+        Use new pool sizes for clients built from now on
+        """
+        self.pool_settings = pool_settings
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    async def aclose(self) -> None:
+        """
+        Close every client and its connection pool, for use on app shutdown
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+
+        for client in clients:
+            closer = getattr(client, "aclose", None) or getattr(client, "close", None)
+            if closer is None:
+                continue
+            result = closer()
+            if inspect.isawaitable(result):
+                await result
+
+    def close(self) -> None:
+        """
+        Synchronous version of aclose() for scripts that don't run an event loop
+        """
+        asyncio.run(self.aclose())
+
+
+registry = ClientRegistry()
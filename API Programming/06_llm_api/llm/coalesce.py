@@ -0,0 +1,152 @@
+import os
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class SharedStream:
+    """
+    One upstream stream read by any number of subscribers
+    Chunks are kept for the life of the stream, so a subscriber that joins late still gets all of them
+    When the last subscriber goes away before the stream ends, the upstream read is cancelled
+    """
+
+    def __init__(self, source: AsyncIterator[str]):
+        self.source = source
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        # Wake everyone waiting on the current event, and give later waiters a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def run(self) -> None:
+        try:
+            async for chunk in self.source:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.done = True
+            self._notify()
+
+    def start(self) -> asyncio.Task:
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """
+        Count the subscriber in before iterating, see SingleFlight.stream
+        """
+        position = 0
+        try:
+            while True:
+                changed = self._changed
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                # nobody is left to read the rest, so stop paying for it
+                self.task.cancel()
+
+
+class SingleFlight:
+    """
+    Shares one upstream call between concurrent identical requests
+    Unlike the completion cache this works at any temperature: requests only share a call that is
+    still in flight, or one that finished less than linger_seconds ago
+    """
+
+    def __init__(self, linger_seconds: float = 0.0):
+        self.linger_seconds = linger_seconds
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.streams: Dict[str, SharedStream] = {}
+        self.upstream = 0
+        self.shared = 0
+
+    @classmethod
+    def from_env(cls) -> "SingleFlight":
+        return cls(linger_seconds=float(os.getenv("LLM_COALESCE_WINDOW", 0.0)))
+
+    def _forget_later(self, registry: Dict[str, Any], key: str, value: Any) -> None:
+        def forget():
+            if registry.get(key) is value:
+                del registry[key]
+
+        if self.linger_seconds > 0:
+            asyncio.get_running_loop().call_later(self.linger_seconds, forget)
+        else:
+            forget()
+
+    def _call_done(self, key: str, task: asyncio.Task) -> None:
+        # Mark the error as seen, in case every caller went away before it arrived
+        if not task.cancelled():
+            task.exception()
+        self._forget_later(self.calls, key, task)
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        :param key: identifies the request, see llm.cache.request_key
+        :param call: makes the upstream call, only invoked if no identical call is in flight
+        :return: the result of the shared call
+        """
+        task = self.calls.get(key)
+        if task is None:
+            self.upstream += 1
+            task = asyncio.ensure_future(call())
+            self.calls[key] = task
+            task.add_done_callback(lambda finished: self._call_done(key, finished))
+        else:
+            self.shared += 1
+        # shield, so one caller going away doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def stream(self, key: str, open_stream: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        :param key: identifies the request, see llm.cache.request_key
+        :param open_stream: opens the upstream stream, only invoked if no identical stream is in flight
+        :return: an async generator of the shared stream's chunks
+        """
+        shared = self.streams.get(key)
+        if shared is None:
+            self.upstream += 1
+            shared = SharedStream(open_stream())
+            self.streams[key] = shared
+            task = shared.start()
+            task.add_done_callback(lambda finished: self._stream_done(key, shared, finished))
+        else:
+            self.shared += 1
+        # counted here rather than when iteration starts, so the stream isn't cancelled
+        # between the last reader leaving and a new one that has joined starting to read
+        shared.subscribers += 1
+        return shared.subscribe()
+
+    def _stream_done(self, key: str, shared: SharedStream, task: asyncio.Task) -> None:
+        if task.cancelled():
+            # a cancelled stream is incomplete, so a new request must not join it
+            if self.streams.get(key) is shared:
+                del self.streams[key]
+        else:
+            self._forget_later(self.streams, key, shared)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "upstream_calls": self.upstream,
+            "shared_calls": self.shared,
+            "in_flight": len(self.calls) + len(self.streams),
+        }
+
+
+flights = SingleFlight.from_env()
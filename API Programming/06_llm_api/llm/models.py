@@ -1,22 +1,53 @@
 import os
+import time
+import asyncio
 from abc import ABC
-from typing import Any, Dict, Self, List, Type
-from openai import OpenAI
+from types import MappingProxyType
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Mapping, Self, List, Optional, Tuple, Type
+import openai
+from openai import OpenAI, AsyncOpenAI
 import google.generativeai
+import google.api_core.exceptions
 import anthropic
-from groq import Groq
+import groq
+from groq import Groq, AsyncGroq
+from llm.clients import registry
+from llm.cache import cache, request_key
+from llm.coalesce import flights
+from llm.resilience import guard_for
+from llm.ratelimit import rate_limiter
 
 
 class LLM(ABC):
     """
     An abstract base class for LLMs
     Use LLM.for_model_name() to instantiate the appropriate subclass, then communicate with send()
+    or, from async code such as the API, with asend()
+    complete() and acomplete() wrap send() and asend() with the shared completion cache and with
+    retries and a circuit breaker per provider (see llm.resilience); aresilient_stream() does the same for astream()
+    The async paths also wait for the provider's rate limits (see llm.ratelimit) before each attempt,
+    and share one upstream call between identical concurrent requests (see llm.coalesce)
+    Subclasses register their model_names automatically when they are defined
     """
 
     model_names = []
     model_name: str
     temperature: float
     client: Any
+    async_client: Any
+    # Errors without an HTTP status that are still worth retrying, such as connection failures
+    transient_errors: Tuple[Type[Exception], ...] = ()
+
+    # Shared by every subclass: model name -> LLM subclass, and provider -> model names
+    _models: Dict[str, Type["LLM"]] = {}
+    _providers: Dict[str, List[str]] = {}
+    _model_names: Optional[List[str]] = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Only register names the subclass declares itself, not ones inherited from a parent provider
+        if "model_names" in cls.__dict__:
+            LLM.register(cls)
 
     def __init__(self, model_name, temperature=1.0):
         self.model_name = model_name
@@ -25,7 +56,8 @@ class LLM(ABC):
 
     def setup_client(self):
         """
-        Implemented by subclasses
+        Implemented by subclasses, fetching shared clients from llm.clients.registry
+        rather than building new ones, so connection pools are reused across requests
         """
         pass
 
@@ -39,23 +71,160 @@ class LLM(ABC):
         """
         pass
 
+    async def asend(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+        """
+        Async version of send(), implemented by subclasses with their provider's async client.
+        The default runs the blocking send() in a worker thread so the event loop is never stalled
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: the response from the LLM
+        """
+        return await asyncio.to_thread(self.send, system_prompt, user_prompt, max_tokens)
+
+    def stream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> Iterator[str]:
+        """
+        Stream the response as it is generated, implemented by subclasses
+        The default yields the whole response from send() as a single chunk
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: a generator of text chunks from the LLM
+        """
+        yield self.send(system_prompt, user_prompt, max_tokens)
+
+    async def astream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """
+        Async version of stream(), implemented by subclasses with their provider's async client
+        The default yields the whole response from asend() as a single chunk
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: an async generator of text chunks from the LLM
+        """
+        yield await self.asend(system_prompt, user_prompt, max_tokens)
+
+    def complete(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+        """
+        send(), answered from the completion cache when the same request was made before
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: the response from the LLM
+        """
+        key = cache.key(self.model_name, system_prompt, user_prompt, self.temperature, max_tokens)
+        if key is not None:
+            content = cache.get(key)
+            if content is not None:
+                return content
+        content = guard_for(type(self).__name__).call(
+            self.send, system_prompt, user_prompt, max_tokens, transient_errors=self.transient_errors
+        )
+        if key is not None:
+            cache.put(key, content)
+        return content
+
+    async def acomplete(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                        on_latency: Optional[Callable[[float], None]] = None) -> str:
+        """
+        asend(), answered from the completion cache when the same request was made before
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :param on_latency: called with the seconds each upstream call took; cache hits, joined
+        in-flight requests and rate limiter waits are not upstream calls, so they aren't reported
+        :return: the response from the LLM
+        """
+        key = cache.key(self.model_name, system_prompt, user_prompt, self.temperature, max_tokens)
+        if key is not None:
+            content = await cache.aget(key)
+            if content is not None:
+                return content
+        content = await flights.do(
+            request_key(self.model_name, system_prompt, user_prompt, self.temperature, max_tokens),
+            lambda: guard_for(type(self).__name__).acall(
+                self.admitted_asend, system_prompt, user_prompt, max_tokens, on_latency,
+                transient_errors=self.transient_errors,
+            ),
+        )
+        if key is not None:
+            await cache.aput(key, content)
+        return content
+
+    def aresilient_stream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """
+        astream(), retried until the first chunk arrives and guarded by the provider's circuit breaker
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: an async generator of text chunks from the LLM
+        """
+        return flights.stream(
+            request_key(self.model_name, system_prompt, user_prompt, self.temperature, max_tokens),
+            lambda: guard_for(type(self).__name__).astream(
+                lambda: self.admitted_astream(system_prompt, user_prompt, max_tokens),
+                transient_errors=self.transient_errors,
+            ),
+        )
+
+    async def admitted_asend(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                             on_latency: Optional[Callable[[float], None]] = None) -> str:
+        """
+        asend(), once the rate limiter admits the request
+        """
+        await rate_limiter.acquire(self.model_name, type(self).__name__, system_prompt, user_prompt, max_tokens)
+        start = time.perf_counter()
+        content = await self.asend(system_prompt, user_prompt, max_tokens)
+        if on_latency is not None:
+            on_latency(time.perf_counter() - start)
+        return content
+
+    async def admitted_astream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """
+        astream(), once the rate limiter admits the request
+        """
+        await rate_limiter.acquire(self.model_name, type(self).__name__, system_prompt, user_prompt, max_tokens)
+        async for chunk in self.astream(system_prompt, user_prompt, max_tokens):
+            yield chunk
+
     def __repr__(self) -> str:
         """
         :return: A string version of the receiver
         """
         return f"<LLM {self.model_name} with temnp={self.temperature}>"
 
+    @staticmethod
+    def register(llm_class: Type["LLM"], model_names: Optional[List[str]] = None) -> None:
+        """
+        Add models to the registry, e.g. for plugin models loaded at runtime
+        A model name that is already registered is moved over to the new class
+        :param llm_class: The LLM subclass that serves these models
+        :param model_names: The names to register, defaults to llm_class.model_names
+        """
+        for model_name in model_names or llm_class.model_names:
+            previous = LLM._models.get(model_name)
+            if previous is not None:
+                LLM._providers[previous.__name__].remove(model_name)
+                if not LLM._providers[previous.__name__]:
+                    del LLM._providers[previous.__name__]
+            LLM._models[model_name] = llm_class
+            LLM._providers.setdefault(llm_class.__name__, []).append(model_name)
+        LLM._model_names = None
+
     @classmethod
-    def model_map(cls) -> Dict[str, Type[Self]]:
+    def model_map(cls) -> Mapping[str, Type[Self]]:
         """
-        Generate a mapping of Model Names to LLM classes, by looking at all subclasses of this one
-        :return: a mapping dictionary from model name to LLM subclass
+        The registry of Model Names to LLM classes, filled in as subclasses are defined
+        :return: a read-only mapping from model name to LLM subclass
         """
-        mapping = {}
-        for llm in cls.__subclasses__():
-            for model_name in llm.model_names:
-                mapping[model_name] = llm
-        return mapping
+        return MappingProxyType(LLM._models)
+
+    @classmethod
+    def providers(cls) -> Mapping[str, List[str]]:
+        """
+        :return: a read-only mapping from provider (the LLM subclass name) to its model names
+        """
+        return MappingProxyType(LLM._providers)
 
     @classmethod
     def for_model_name(cls, model_name: str, temperature=0.7) -> Self:
@@ -65,8 +234,7 @@ class LLM(ABC):
         :param temperature: The temperature to be used in this model
         :return: an initialized instance of an LLM subclass
         """
-        mapping = cls.model_map()
-        llm_class = mapping[model_name]
+        llm_class = LLM._models[model_name]
         llm = llm_class(model_name, temperature)
         return llm
 
@@ -75,7 +243,9 @@ class LLM(ABC):
         """
         :return: a list of names of all the models supported
         """
-        return list(cls.model_map().keys())
+        if LLM._model_names is None:
+            LLM._model_names = list(LLM._models)
+        return LLM._model_names
 
 
 class GPT(LLM):
@@ -87,8 +257,18 @@ class GPT(LLM):
         "gpt-4o-mini",
     ]
 
+    transient_errors = (openai.APIConnectionError,)
+
     def setup_client(self):
-        self.client = OpenAI()
+        # Retries are handled by llm.resilience, so the SDK's own retries are turned off
+        self.client = registry.get(
+            "openai",
+            lambda pool: OpenAI(max_retries=0, http_client=openai.DefaultHttpxClient(limits=pool.limits())),
+        )
+        self.async_client = registry.get(
+            "openai-async",
+            lambda pool: AsyncOpenAI(max_retries=0, http_client=openai.DefaultAsyncHttpxClient(limits=pool.limits())),
+        )
 
     def send(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
         """
@@ -104,10 +284,74 @@ class GPT(LLM):
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt},
             ],
-            temperature=1.0
+            temperature=self.temperature,
+            max_tokens=max_tokens,
         )
         return completion.choices[0].message.content
 
+    async def asend(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+        """
+        Async implementation for OpenAI / GPT
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: the response from the LLM
+        """
+        completion = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+        )
+        return completion.choices[0].message.content
+
+    def stream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> Iterator[str]:
+        """
+        Streaming implementation for OpenAI / GPT
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: a generator of text chunks from the LLM
+        """
+        chunks = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def astream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """
+        Async streaming implementation for OpenAI / GPT
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: an async generator of text chunks from the LLM
+        """
+        chunks = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
 
 class Claude(LLM):
 
@@ -117,8 +361,21 @@ class Claude(LLM):
         "claude-3-haiku-20240307",
     ]
 
+    transient_errors = (anthropic.APIConnectionError,)
+
     def setup_client(self):
-        self.client = anthropic.Anthropic()
+        self.client = registry.get(
+            "anthropic",
+            lambda pool: anthropic.Anthropic(
+                max_retries=0, http_client=anthropic.DefaultHttpxClient(limits=pool.limits())
+            ),
+        )
+        self.async_client = registry.get(
+            "anthropic-async",
+            lambda pool: anthropic.AsyncAnthropic(
+                max_retries=0, http_client=anthropic.DefaultAsyncHttpxClient(limits=pool.limits())
+            ),
+        )
 
     def send(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
         """
@@ -139,29 +396,96 @@ class Claude(LLM):
         )
         return message.content[0].text
 
+    async def asend(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+        """
+        Async implementation for Anthropic / Claude
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: the response from the LLM
+        """
+        message = await self.async_client.messages.create(
+            model=self.model_name,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            system=system_prompt,
+            messages=[
+                {"role": "user", "content": user_prompt},
+            ],
+        )
+        return message.content[0].text
+
+    def stream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> Iterator[str]:
+        """
+        Streaming implementation for Anthropic / Claude
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: a generator of text chunks from the LLM
+        """
+        with self.client.messages.stream(
+            model=self.model_name,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            system=system_prompt,
+            messages=[
+                {"role": "user", "content": user_prompt},
+            ],
+        ) as stream:
+            yield from stream.text_stream
+
+    async def astream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """
+        Async streaming implementation for Anthropic / Claude
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: an async generator of text chunks from the LLM
+        """
+        async with self.async_client.messages.stream(
+            model=self.model_name,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            system=system_prompt,
+            messages=[
+                {"role": "user", "content": user_prompt},
+            ],
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+
 
 class Gemini(LLM):
 
     model_names = ["gemini-1.0-pro", "gemini-1.5-flash", "gemini-2.0-flash"]
+    # google.api_core errors carry their HTTP status in .code, which llm.resilience checks directly
+    transient_errors = (google.api_core.exceptions.DeadlineExceeded,)
 
-    def setup_client(self):
+    @staticmethod
+    def build_client(pool, model_name: str):
+        # The Gemini SDK manages its own gRPC channel, so the pool sizes don't apply here
         google.generativeai.configure()
-        self.client = google.generativeai.GenerativeModel(self.model_name)
+        return google.generativeai.GenerativeModel(model_name)
 
-    def send(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+    def setup_client(self):
+        self.client = registry.get("gemini", self.build_client, model_name=self.model_name)
+        # GenerativeModel carries its own async transport, exposed through generate_content_async
+        self.async_client = self.client
+
+    @staticmethod
+    def build_message(system_prompt: str, user_prompt: str, max_tokens: int) -> str:
         """
-        Implementation for Google / Gemini
-        :param system_prompt: The system prompt passed to the LLM
-        :param user_prompt: The user prompt passed to the LLM
-        :param max_tokens: Maximum number of tokens
-        :return: the response from the LLM
+        Gemini has no separate system role here, so fold both prompts into a single message
         """
         words = int(max_tokens * 0.75)
         message = "First, here is a System Message to set context and instructions:\n\n"
         message += system_prompt + "\n\n"
         message += f"Now here is the User's Request - please respond in under {words} words:\n\n"
         message += user_prompt + "\n"
-        response = self.client.generate_content(message)
+        return message
+
+    @staticmethod
+    def parse_response(response) -> str:
         first_candidate = response.candidates[0]
 
         if first_candidate.content.parts:
@@ -169,6 +493,58 @@ class Gemini(LLM):
             return myanswer1
         raise ValueError("Could not parse response from Gemini")
 
+    def send(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+        """
+        Implementation for Google / Gemini
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: the response from the LLM
+        """
+        message = self.build_message(system_prompt, user_prompt, max_tokens)
+        response = self.client.generate_content(message)
+        return self.parse_response(response)
+
+    async def asend(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+        """
+        Async implementation for Google / Gemini
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: the response from the LLM
+        """
+        message = self.build_message(system_prompt, user_prompt, max_tokens)
+        response = await self.async_client.generate_content_async(message)
+        return self.parse_response(response)
+
+    def stream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> Iterator[str]:
+        """
+        Streaming implementation for Google / Gemini
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: a generator of text chunks from the LLM
+        """
+        message = self.build_message(system_prompt, user_prompt, max_tokens)
+        for chunk in self.client.generate_content(message, stream=True):
+            # chunks without parts (e.g. safety metadata) have no text
+            if chunk.parts and chunk.text:
+                yield chunk.text
+
+    async def astream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """
+        Async streaming implementation for Google / Gemini
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: an async generator of text chunks from the LLM
+        """
+        message = self.build_message(system_prompt, user_prompt, max_tokens)
+        response = await self.async_client.generate_content_async(message, stream=True)
+        async for chunk in response:
+            if chunk.parts and chunk.text:
+                yield chunk.text
+
 
 class GroqAPI(LLM):
     """
@@ -181,8 +557,16 @@ class GroqAPI(LLM):
         "mixtral-8x7b-32768",
     ]
 
+    transient_errors = (groq.APIConnectionError,)
+
     def setup_client(self):
-        self.client = Groq()
+        self.client = registry.get(
+            "groq", lambda pool: Groq(max_retries=0, http_client=groq.DefaultHttpxClient(limits=pool.limits()))
+        )
+        self.async_client = registry.get(
+            "groq-async",
+            lambda pool: AsyncGroq(max_retries=0, http_client=groq.DefaultAsyncHttpxClient(limits=pool.limits())),
+        )
 
     def send(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
         """
@@ -198,7 +582,73 @@ class GroqAPI(LLM):
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt},
             ],
-            temperature=1.0,
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"},
+        )
+        return completion.choices[0].message.content
+
+    async def asend(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+        """
+        Async implementation for Groq
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: the response from the LLM
+        """
+        completion = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=self.temperature,
+            max_tokens=max_tokens,
             response_format={"type": "json_object"},
         )
-        return completion.choices[0].message.content
\ No newline at end of file
+        return completion.choices[0].message.content
+
+    def stream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> Iterator[str]:
+        """
+        Streaming implementation for Groq
+        Groq's JSON mode can't be streamed, so the stream asks for plain text
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: a generator of text chunks from the LLM
+        """
+        chunks = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def astream(self, system_prompt: str, user_prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """
+        Async streaming implementation for Groq
+        :param system_prompt: The system prompt passed to the LLM
+        :param user_prompt: The user prompt passed to the LLM
+        :param max_tokens: Maximum number of tokens
+        :return: an async generator of text chunks from the LLM
+        """
+        chunks = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
\ No newline at end of file
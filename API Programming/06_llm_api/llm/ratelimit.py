@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional, Tuple
+
+# Who is making the current request; the API sets this per request so queues are fair between callers
+caller_id: ContextVar[str] = ContextVar("caller_id", default="anonymous")
+
+# Requests and tokens per minute, keyed by model name or provider (LLM subclass name).
+# These depend on the account tier, so none are assumed; set LLM_RATE_LIMITS, for example
+# {"GroqAPI": {"rpm": 30, "tpm": 6000}, "gpt-4o-mini": {"rpm": 500, "tpm": 200000}}
+DEFAULT_RATE_LIMITS: Dict[str, Dict[str, float]] = {}
+
+
+def estimate_tokens(system_prompt: str, user_prompt: str, max_tokens: int) -> int:
+    """
+    A rough count of the tokens a request will use: ~4 characters per prompt token,
+    plus max_tokens, which providers count against the quota when the request is admitted
+    """
+    return (len(system_prompt) + len(user_prompt)) // 4 + max_tokens
+
+
+class TokenBucket:
+    """
+    Holds up to capacity units and refills continuously at capacity per minute
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        :return: seconds until amount is available, 0 if it is available now
+        """
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimitScheduler:
+    """
+    Admits requests for one model or provider at the highest rate that stays under its RPM and TPM,
+    instead of sending them and collecting 429s
+    Waiting requests queue per caller, and callers take turns, so one busy caller can't starve the rest
+    """
+
+    def __init__(self, name: str, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.queues: "OrderedDict[str, Deque[Tuple[int, asyncio.Future]]]" = OrderedDict()
+        self.admitted = 0
+        self.total_wait = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        Wait until this request can be sent without exceeding the limits
+        :param tokens: the estimated tokens for the request
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(caller_id.get(), deque()).append((tokens, future))
+        start = time.monotonic()
+        self._pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._discard(future)
+            self._pump()
+            raise
+        self.admitted += 1
+        self.total_wait += time.monotonic() - start
+
+    def _discard(self, future: asyncio.Future) -> None:
+        for caller, queue in list(self.queues.items()):
+            for entry in queue:
+                if entry[1] is future:
+                    queue.remove(entry)
+                    if not queue:
+                        del self.queues[caller]
+                    return
+
+    def _pump(self) -> None:
+        """
+        Admit queued requests in round-robin order of callers while the buckets allow,
+        then set a timer for when the next one will fit
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        while self.queues:
+            caller, queue = next(iter(self.queues.items()))
+            tokens, future = queue[0]
+            wait = 0.0
+            if self.requests is not None:
+                self.requests.refill(now)
+                wait = max(wait, self.requests.wait_time(1))
+            if self.tokens is not None:
+                self.tokens.refill(now)
+                wait = max(wait, self.tokens.wait_time(tokens))
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._pump)
+                return
+
+            queue.popleft()
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            # this caller goes to the back of the line
+            del self.queues[caller]
+            if queue:
+                self.queues[caller] = queue
+            if not future.done():
+                future.set_result(None)
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth(),
+            "waiting_callers": len(self.queues),
+            "admitted": self.admitted,
+            "average_wait_seconds": self.total_wait / self.admitted if self.admitted else 0.0,
+        }
+
+
+class RateLimiter:
+    """
+    One scheduler per configured model or provider; a request waits for both its model's limits
+    and its provider's shared ones, and requests with no configured limits go straight through
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, float]]):
+        self.limits = limits
+        self.schedulers: Dict[str, RateLimitScheduler] = {}
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        limits = dict(DEFAULT_RATE_LIMITS)
+        limits.update(json.loads(os.getenv("LLM_RATE_LIMITS", "{}")))
+        return cls(limits)
+
+    def scheduler_for(self, key: str) -> Optional[RateLimitScheduler]:
+        """
+        :param key: a model name or a provider
+        :return: the scheduler for key's limits, or None when it has none configured
+        """
+        if key not in self.limits:
+            return None
+        scheduler = self.schedulers.get(key)
+        if scheduler is None:
+            limits = self.limits[key]
+            scheduler = self.schedulers[key] = RateLimitScheduler(key, limits.get("rpm"), limits.get("tpm"))
+        return scheduler
+
+    async def acquire(self, model_name: str, provider: str, system_prompt: str, user_prompt: str,
+                      max_tokens: int) -> None:
+        """
+        Wait for the model's own limits, then for its provider's, which every model of the provider shares
+        """
+        tokens = estimate_tokens(system_prompt, user_prompt, max_tokens)
+        for key in (model_name, provider):
+            scheduler = self.scheduler_for(key)
+            if scheduler is not None:
+                await scheduler.acquire(tokens)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: scheduler.stats() for name, scheduler in self.schedulers.items()}
+
+
+rate_limiter = RateLimiter.from_env()
@@ -0,0 +1,308 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: timeouts, conflicts, rate limits, server errors and Anthropic's 529 "overloaded"
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the provider while its circuit breaker is open
+    """
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"{provider} is failing, not sending requests for another {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+@dataclass
+class RetryPolicy:
+    """
+    How hard to retry one provider, following the notes in "Retry and Backoff Strategies"
+    Configure with LLM_RETRY_MAX_ATTEMPTS, LLM_RETRY_INITIAL_DELAY, LLM_RETRY_MAX_DELAY,
+    LLM_RETRY_BUDGET_RATIO, LLM_BREAKER_FAILURES and LLM_BREAKER_RESET_SECONDS
+    """
+
+    max_attempts: int = 3
+    initial_delay: float = 0.5
+    max_delay: float = 20.0
+    # retries may use at most this fraction of request volume, plus a small allowance at low volume
+    budget_ratio: float = 0.1
+    budget_allowance: float = 10.0
+    # consecutive transient failures before the breaker opens, and how long it stays open
+    failure_threshold: int = 5
+    reset_seconds: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        return cls(
+            max_attempts=int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", cls.max_attempts)),
+            initial_delay=float(os.getenv("LLM_RETRY_INITIAL_DELAY", cls.initial_delay)),
+            max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", cls.max_delay)),
+            budget_ratio=float(os.getenv("LLM_RETRY_BUDGET_RATIO", cls.budget_ratio)),
+            failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", cls.failure_threshold)),
+            reset_seconds=float(os.getenv("LLM_BREAKER_RESET_SECONDS", cls.reset_seconds)),
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Exponential backoff with jitter, between half and all of the capped exponential delay
+        """
+        backoff = min(self.max_delay, self.initial_delay * (2 ** (attempt - 1)))
+        return random.uniform(backoff / 2, backoff)
+
+
+class RetryBudget:
+    """
+    Every request earns budget_ratio of a retry, and every retry spends one,
+    so a struggling provider sees at most ~10% extra traffic instead of a retry storm
+    """
+
+    def __init__(self, ratio: float, allowance: float):
+        self.ratio = ratio
+        self.allowance = allowance
+        self.balance = allowance
+        self._lock = threading.Lock()
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.balance = min(self.allowance, self.balance + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. Open: calls fail fast until reset_seconds have passed.
+    Half-open: one probe call is let through, and its result closes or re-opens the breaker
+    """
+
+    def __init__(self, provider: str, failure_threshold: int, reset_seconds: float):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half-open"
+
+    def before_call(self) -> None:
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.probing):
+                retry_after = max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+                raise CircuitOpenError(self.provider, retry_after)
+            if state == "half-open":
+                self.probing = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.probing:
+                    logger.warning(f"Circuit breaker for {self.provider} is open after {self.failures} failures")
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def release_probe(self) -> None:
+        # A probe that failed for a non-transient reason says nothing about the provider's health
+        with self._lock:
+            self.probing = False
+
+
+def status_code_of(exc: Exception) -> Optional[int]:
+    # openai, anthropic and groq errors carry status_code, google.api_core errors carry code
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(exc, "code", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after_of(exc: Exception) -> Optional[float]:
+    """
+    :return: the delay the provider asked for in its Retry-After header, if any
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class ProviderGuard:
+    """
+    Retries, retry budget and circuit breaker for the calls to one provider
+    """
+
+    def __init__(self, provider: str, policy: RetryPolicy):
+        self.provider = provider
+        self.policy = policy
+        self.budget = RetryBudget(policy.budget_ratio, policy.budget_allowance)
+        self.breaker = CircuitBreaker(provider, policy.failure_threshold, policy.reset_seconds)
+
+    def is_transient(self, exc: Exception, transient_errors: Tuple[Type[Exception], ...]) -> bool:
+        if isinstance(exc, transient_errors):
+            return True
+        return status_code_of(exc) in RETRY_STATUS_CODES
+
+    def _on_failure(self, exc: Exception, attempt: int, transient_errors) -> Optional[float]:
+        """
+        Record a failed attempt
+        :return: how long to wait before retrying, or None to give up and raise
+        """
+        if not self.is_transient(exc, transient_errors):
+            self.breaker.release_probe()
+            return None
+        self.breaker.record_failure()
+        if attempt >= self.policy.max_attempts or self.breaker.state != "closed" or not self.budget.try_spend():
+            return None
+        delay = self.policy.backoff(attempt)
+        retry_after = retry_after_of(exc)
+        if retry_after is not None:
+            # honour the provider's Retry-After, but never wait longer than max_delay inside a request
+            if retry_after > self.policy.max_delay:
+                return None
+            delay = max(delay, retry_after)
+        logger.info(f"{self.provider} attempt {attempt} failed ({exc}), retrying in {delay:.2f}s")
+        return delay
+
+    def call(self, func: Callable[..., Any], *args, transient_errors: Tuple[Type[Exception], ...] = ()) -> Any:
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            try:
+                result = func(*args)
+            except Exception as exc:
+                delay = self._on_failure(exc, attempt, transient_errors)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def acall(self, func: Callable[..., Any], *args, transient_errors: Tuple[Type[Exception], ...] = ()) -> Any:
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            try:
+                result = await func(*args)
+            except Exception as exc:
+                delay = self._on_failure(exc, attempt, transient_errors)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            except BaseException:
+                # e.g. the request was cancelled, which says nothing about the provider's health
+                self.breaker.release_probe()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def astream(self, open_stream: Callable[[], AsyncIterator[str]],
+                      transient_errors: Tuple[Type[Exception], ...] = ()) -> AsyncIterator[str]:
+        """
+        Retry a stream until its first chunk arrives; once text has been sent to the
+        caller a failure can't be retried transparently, so it is recorded and raised
+        """
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            stream = open_stream()
+            try:
+                first = await anext(stream)
+            except StopAsyncIteration:
+                self.breaker.record_success()
+                return
+            except Exception as exc:
+                delay = self._on_failure(exc, attempt, transient_errors)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            # the provider is answering, which is all the breaker needs to know
+            self.breaker.record_success()
+            break
+
+        yield first
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception as exc:
+            if self.is_transient(exc, transient_errors):
+                self.breaker.record_failure()
+            raise
+
+
+_guards: Dict[str, ProviderGuard] = {}
+_guards_lock = threading.Lock()
+policy = RetryPolicy.from_env()
+
+
+def guard_for(provider: str) -> ProviderGuard:
+    guard = _guards.get(provider)
+    if guard is None:
+        with _guards_lock:
+            guard = _guards.setdefault(provider, ProviderGuard(provider, policy))
+    return guard
+
+
+def breaker_states() -> Dict[str, str]:
+    return {provider: guard.breaker.state for provider, guard in _guards.items()}
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from llm.models import LLM
+from llm.resilience import guard_for
+
+logger = logging.getLogger(__name__)
+
+# Routing groups a request can name instead of a model; LLM_ROUTES (JSON) adds to or replaces these
+DEFAULT_ROUTES = {
+    "fast-chat": ["gpt-4o-mini", "claude-3-haiku-20240307", "gemini-2.0-flash"],
+}
+
+
+class LatencyTracker:
+    """
+    Recent latencies and outcomes for one model, over a sliding window of calls
+    """
+
+    def __init__(self, window: int = 100):
+        self.samples: Deque[Tuple[float, bool]] = deque(maxlen=window)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        self.samples.append((seconds, ok))
+
+    def p95(self) -> float:
+        """
+        :return: the 95th percentile latency of successful calls, 0 when there is no data yet
+        so that new members get tried and measured
+        """
+        latencies = sorted(seconds for seconds, ok in self.samples if ok)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+
+class Router:
+    """
+    Sends each call for a routing group to the healthy member with the lowest recent p95 latency,
+    and falls over to the next member when a call fails
+    With hedge_after set, a duplicate request goes to the next member if the first hasn't
+    answered within that many seconds, and whichever answers first wins
+    """
+
+    def __init__(self, routes: Dict[str, List[str]], max_error_rate: float = 0.5,
+                 hedge_after: Optional[float] = None):
+        self.routes = routes
+        self.max_error_rate = max_error_rate
+        self.hedge_after = hedge_after
+        self.trackers: Dict[str, LatencyTracker] = {}
+
+    @classmethod
+    def from_env(cls) -> "Router":
+        """
+        Configure from LLM_ROUTES (a JSON object of group name to model names),
+        LLM_ROUTE_MAX_ERROR_RATE and LLM_HEDGE_AFTER (seconds, unset to disable hedging)
+        """
+        routes = dict(DEFAULT_ROUTES)
+        routes.update(json.loads(os.getenv("LLM_ROUTES", "{}")))
+        hedge_after = os.getenv("LLM_HEDGE_AFTER")
+        return cls(
+            routes,
+            max_error_rate=float(os.getenv("LLM_ROUTE_MAX_ERROR_RATE", 0.5)),
+            hedge_after=float(hedge_after) if hedge_after else None,
+        )
+
+    def is_group(self, name: str) -> bool:
+        return name in self.routes
+
+    def tracker(self, model_name: str) -> LatencyTracker:
+        tracker = self.trackers.get(model_name)
+        if tracker is None:
+            tracker = self.trackers[model_name] = LatencyTracker()
+        return tracker
+
+    def healthy(self, model_name: str) -> bool:
+        provider = LLM.model_map()[model_name].__name__
+        if guard_for(provider).breaker.state == "open":
+            return False
+        return self.tracker(model_name).error_rate() <= self.max_error_rate
+
+    def ranked(self, group: str) -> List[str]:
+        """
+        :return: the group's members, healthy ones first, each part ordered by recent p95 latency
+        """
+        members = [model_name for model_name in self.routes[group] if model_name in LLM.model_map()]
+        by_latency = sorted(members, key=lambda model_name: self.tracker(model_name).p95())
+        healthy = [model_name for model_name in by_latency if self.healthy(model_name)]
+        return healthy + [model_name for model_name in by_latency if model_name not in healthy]
+
+    async def _attempt(self, model_name: str, system_prompt: str, user_prompt: str, max_tokens: int,
+                       temperature: float, slot_for: Optional[Callable[[str], asyncio.Semaphore]]) -> Tuple[str, str]:
+        tracker = self.tracker(model_name)
+        start = time.perf_counter()
+        try:
+            llm = LLM.for_model_name(model_name, temperature=temperature)
+            # only upstream calls are timed, so cache hits and rate limiter waits don't skew the p95
+            on_latency = lambda seconds: tracker.record(seconds, ok=True)
+            if slot_for is None:
+                content = await llm.acomplete(system_prompt, user_prompt, max_tokens, on_latency)
+            else:
+                async with slot_for(type(llm).__name__):
+                    content = await llm.acomplete(system_prompt, user_prompt, max_tokens, on_latency)
+        except Exception:
+            tracker.record(time.perf_counter() - start, ok=False)
+            raise
+        return model_name, content
+
+    async def complete(self, group: str, system_prompt: str, user_prompt: str, max_tokens: int,
+                       temperature: float,
+                       slot_for: Optional[Callable[[str], asyncio.Semaphore]] = None) -> Tuple[str, str]:
+        """
+        Complete a request with the best member of a routing group
+        :param slot_for: a semaphore per provider to hold during each attempt, e.g. the batch limiter's
+        :return: the name of the model that answered, and its response
+        """
+        candidates = self.ranked(group)
+        if not candidates:
+            raise KeyError(group)
+
+        pending = set()
+        last_error: Optional[Exception] = None
+        try:
+            while candidates or pending:
+                if candidates and (not pending or self.hedge_after is not None):
+                    model_name = candidates.pop(0)
+                    pending.add(asyncio.ensure_future(
+                        self._attempt(model_name, system_prompt, user_prompt, max_tokens, temperature, slot_for)
+                    ))
+                # Without hedging, wait for the one attempt; with it, only wait hedge_after before adding another
+                timeout = self.hedge_after if candidates and self.hedge_after is not None else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"Routing group {group}: a member failed ({last_error}), falling over")
+        finally:
+            for task in pending:
+                task.cancel()
+        raise last_error
+
+    def stats(self) -> Dict[str, Dict[str, dict]]:
+        return {
+            group: {
+                model_name: {
+                    "p95_seconds": self.tracker(model_name).p95(),
+                    "error_rate": self.tracker(model_name).error_rate(),
+                    "samples": len(self.tracker(model_name).samples),
+                }
+                for model_name in members
+            }
+            for group, members in self.routes.items()
+        }
+
+
+router = Router.from_env()
@@ -1,52 +1,164 @@
-
+import os
+import glob
+import json
+import time
+import hashlib
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice
 
 import PyPDF2
 import chromadb
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from chromadb.utils import embedding_functions
 
+from embedding_cache import CachedEmbeddingFunction
+
 
+_default_ef = None
 
-default_ef = embedding_functions.DefaultEmbeddingFunction()
+
+def get_default_ef():
+    # cached on disk (EMBEDDING_CACHE_PATH), so re-indexing unchanged chunks and repeated queries skip the model;
+    # built on first use, so importing this module doesn't create the cache file
+    global _default_ef
+    if _default_ef is None:
+        _default_ef = CachedEmbeddingFunction(embedding_functions.DefaultEmbeddingFunction(),
+                                              model_name="all-MiniLM-L6-v2")
+    return _default_ef
 
 
 def extract_text_from_pdf(pdf_path):
     with open(pdf_path, 'rb') as file:
         pdf_reader = PyPDF2.PdfReader(file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-        return text
-    
-def create_chunks(text):
-    text_splitter = RecursiveCharacterTextSplitter(
+        # join once at the end; += on a growing string copies the whole text for every page
+        return "".join(page.extract_text() for page in pdf_reader.pages)
+
+
+def count_pages(pdf_path):
+    with open(pdf_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def extract_page_range(pdf_path, start, stop):
+    # runs in a worker process, so each task opens its own reader
+    with open(pdf_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [pdf_reader.pages[number].extract_text() or "" for number in range(start, stop)]
+
+
+def iter_pages(pdf_paths, executor, pages_per_task=16, max_pending=8):
+    """
+    Yield (pdf_path, page_number, text) for every page of every PDF, in order.
+    Page ranges are extracted in the executor's worker processes, and at most max_pending
+    ranges are in flight at a time, so memory stays bounded however many pages there are
+    """
+    tasks = (
+        (pdf_path, start, min(start + pages_per_task, page_count))
+        for pdf_path in pdf_paths
+        for page_count in [count_pages(pdf_path)]
+        for start in range(0, page_count, pages_per_task)
+    )
+    pending = deque()
+    for pdf_path, start, stop in tasks:
+        pending.append((pdf_path, start, executor.submit(extract_page_range, pdf_path, start, stop)))
+        if len(pending) >= max_pending:
+            yield from _finished_pages(pending.popleft())
+    while pending:
+        yield from _finished_pages(pending.popleft())
+
+
+def _finished_pages(task):
+    pdf_path, start, future = task
+    for offset, text in enumerate(future.result()):
+        yield pdf_path, start + offset, text
+
+
+def iter_chunks(pages, text_splitter=None):
+    """
+    Yield (chunk, metadata) for each page as it arrives; chunks don't span pages,
+    which keeps only one page of text in memory and gives every chunk its page number
+    """
+    text_splitter = text_splitter or make_text_splitter()
+    for pdf_path, page_number, text in pages:
+        for i, chunk in enumerate(text_splitter.split_text(text)):
+            yield chunk, {"source": os.path.basename(pdf_path), "page": page_number, "chunk_id": i}
+
+
+def chunk_id(source, chunk, occurrence=0):
+    """
+    A stable id from the document name and the chunk's text, so an unchanged chunk keeps its id
+    when the rest of the document is edited; occurrence tells repeated chunks of one document apart
+    """
+    return hashlib.sha256(f"{source}\0{occurrence}\0{chunk}".encode()).hexdigest()[:32]
+
+
+def with_chunk_ids(chunks):
+    """
+    Add an "id" to the metadata of each (chunk, metadata) from iter_chunks
+    """
+    occurrences = Counter()
+    current_source = None
+    for chunk, metadata in chunks:
+        if metadata["source"] != current_source:
+            occurrences.clear()
+            current_source = metadata["source"]
+        metadata["id"] = chunk_id(current_source, chunk, occurrences[chunk])
+        occurrences[chunk] += 1
+        yield chunk, metadata
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def make_text_splitter():
+    return RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=200,
         length_function=len,
         separators=["\n\n", "\n", " ", ""]
     )
-    chunks = text_splitter.split_text(text)
+
+
+def create_chunks(text):
+    chunks = make_text_splitter().split_text(text)
     return chunks
 
-def store_in_chromadb(chunks, collection_name="pdf_chunks"):
+def store_in_chromadb(chunks, collection_name="pdf_chunks", source="document"):
+    # chunk ids hash the source with the text, so pass each document's own source
+    # to keep identical chunks of two documents apart
     client = chromadb.Client()
 
     collection = client.get_or_create_collection(
         name=collection_name,
-        embedding_function=default_ef
+        embedding_function=get_default_ef()
     )
     
 
     documents = []
     metadatas = []
     ids = []
+    occurrences = Counter()
     
     for i, chunk in enumerate(chunks):
         documents.append(chunk)
-        metadatas.append({"source": "pdf", "chunk_id": i})
-        ids.append(f"chunk_{i}")
+        metadatas.append({"source": source, "chunk_id": i})
+        ids.append(chunk_id(source, chunk, occurrences[chunk]))
+        occurrences[chunk] += 1
     
-    collection.add(
+    # content-hashed ids make a re-run overwrite the same chunks instead of adding copies
+    collection.upsert(
         documents=documents,
         metadatas=metadatas,
         ids=ids
@@ -55,14 +167,172 @@ def store_in_chromadb(chunks, collection_name="pdf_chunks"):
     return collection
 
 
-def process_pdf(pdf_path, collection_name="pdf_chunks"):
+def ingest_pdfs(pdf_paths, collection_name="pdf_chunks", client=None, workers=None, batch_size=256):
+    """
+    Streaming ingestion for a directory (or list) of PDFs: pages are extracted in a process pool,
+    split into chunks as they arrive, embedded batch_size chunks at a time and written to Chroma
+    one batch per add, so memory depends on the batch size rather than the number of pages
+    """
+    if isinstance(pdf_paths, str):
+        pdf_paths = sorted(glob.glob(os.path.join(pdf_paths, "*.pdf"))) if os.path.isdir(pdf_paths) else [pdf_paths]
+    client = client or chromadb.Client()
+    collection = client.get_or_create_collection(
+        name=collection_name,
+        embedding_function=get_default_ef()
+    )
 
-    text = extract_text_from_pdf(pdf_path)
-    
-    chunks = create_chunks(text)
-    print(f"Created {len(chunks)} chunks from the PDF")
+    workers = workers or os.cpu_count() or 1
+    page_count = 0
+    chunk_count = 0
+
+    def counted(pages):
+        nonlocal page_count
+        for page in pages:
+            page_count += 1
+            yield page
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        pages = counted(iter_pages(pdf_paths, executor, max_pending=2 * workers))
+        for batch in batched(with_chunk_ids(iter_chunks(pages)), batch_size):
+            documents = [chunk for chunk, _ in batch]
+            metadatas = [metadata for _, metadata in batch]
+            collection.add(
+                documents=documents,
+                metadatas=metadatas,
+                embeddings=get_default_ef()(documents),
+                ids=[metadata.pop("id") for metadata in metadatas]
+            )
+            chunk_count += len(batch)
+            elapsed = time.perf_counter() - start
+            print(f"{page_count} pages ({page_count / elapsed:.1f} pages/sec), "
+                  f"{chunk_count} chunks ({chunk_count / elapsed:.1f} chunks/sec)")
+
+    return collection
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, manifest_path):
+    # write a new file and swap it in, so a crash never leaves a half-written manifest
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def reindex_pdfs(pdf_dir, collection_name="pdf_chunks", client=None, manifest_path=None, workers=None,
+                 batch_size=256, persist_directory="chroma_db"):
+    """
+    Bring a collection up to date with a directory of PDFs, doing work only for what changed.
+    The manifest records each file's hash and the ids of its chunks. Unchanged files are skipped
+    without being read; for a changed file only chunks whose content is new get embedded and upserted,
+    kept chunks get their new page numbers, and chunks that disappeared are deleted.
+    Files that are gone lose all their chunks. The collection has to outlive the run for the manifest
+    to mean anything, so without a client it is stored in persist_directory. Chunks the manifest lists
+    but the collection has lost are embedded again; rows the manifest doesn't list are never touched
+    """
+    manifest_path = manifest_path or f"{collection_name}.manifest.json"
+    manifest = load_manifest(manifest_path)
+    client = client or chromadb.PersistentClient(path=persist_directory)
+    collection = client.get_or_create_collection(
+        name=collection_name,
+        embedding_function=get_default_ef()
+    )
+
+    manifest_ids = [chunk_id for entry in manifest.values() for chunk_id in entry["ids"]]
+    present = set()
+    for part in batched(manifest_ids, 5000):
+        present.update(collection.get(ids=part, include=[])["ids"])
+    missing = set(manifest_ids) - present
+    if missing:
+        print(f"{len(missing)} chunks listed in {manifest_path} are missing from {collection_name}; re-adding them")
+
+    def indexed_ids(source):
+        return set(manifest.get(source, {}).get("ids", [])) - missing
+
+    def is_changed(source):
+        entry = manifest.get(source, {})
+        return entry.get("sha256") != hashes[source] or not missing.isdisjoint(entry.get("ids", []))
+
+    pdf_paths = sorted(glob.glob(os.path.join(pdf_dir, "*.pdf")))
+    hashes = {os.path.basename(path): file_sha256(path) for path in pdf_paths}
+    changed = [path for path in pdf_paths if is_changed(os.path.basename(path))]
+    stats = {"unchanged_files": len(pdf_paths) - len(changed), "embedded": 0, "kept": 0, "deleted": 0}
+
+    def finish(source, chunk_ids, pending, kept):
+        old_ids = indexed_ids(source)
+        if pending:
+            flush(pending)
+        if kept:
+            update(kept)
+        stale = list(old_ids - set(chunk_ids))
+        if stale:
+            collection.delete(ids=stale)
+        stats["deleted"] += len(stale)
+        manifest[source] = {"sha256": hashes[source], "ids": chunk_ids}
+        save_manifest(manifest, manifest_path)
+
+    def flush(pending):
+        documents = [chunk for chunk, _ in pending]
+        metadatas = [metadata for _, metadata in pending]
+        collection.upsert(
+            documents=documents,
+            metadatas=metadatas,
+            embeddings=get_default_ef()(documents),
+            ids=[metadata.pop("id") for metadata in metadatas]
+        )
+        stats["embedded"] += len(pending)
+        pending.clear()
+
+    def update(kept):
+        # an unchanged chunk can still have moved to another page or position
+        metadatas = [metadata for _, metadata in kept]
+        collection.update(ids=[metadata.pop("id") for metadata in metadatas], metadatas=metadatas)
+        stats["kept"] += len(kept)
+        kept.clear()
+
+    seen = set()
+    with ProcessPoolExecutor(workers) as executor:
+        chunks = with_chunk_ids(iter_chunks(iter_pages(changed, executor)))
+        for source, document_chunks in groupby(chunks, key=lambda item: item[1]["source"]):
+            seen.add(source)
+            old_ids = indexed_ids(source)
+            chunk_ids, pending, kept = [], [], []
+            for chunk, metadata in document_chunks:
+                chunk_ids.append(metadata["id"])
+                if metadata["id"] in old_ids:
+                    kept.append((chunk, metadata))
+                    if len(kept) >= batch_size:
+                        update(kept)
+                    continue
+                pending.append((chunk, metadata))
+                if len(pending) >= batch_size:
+                    flush(pending)
+            finish(source, chunk_ids, pending, kept)
+
+    # changed files with no text at all, and files that were removed from the directory
+    for source in [path for path in map(os.path.basename, changed) if path not in seen]:
+        finish(source, [], [], [])
+    for source in [source for source in manifest if source not in hashes]:
+        stale = manifest.pop(source)["ids"]
+        if stale:
+            collection.delete(ids=stale)
+        stats["deleted"] += len(stale)
+        save_manifest(manifest, manifest_path)
+
+    print(f"Re-indexed {len(changed)} changed of {len(pdf_paths)} files: {stats}")
+    return collection
+
+
+def process_pdf(pdf_path, collection_name="pdf_chunks"):
 
-    collection = store_in_chromadb(chunks, collection_name)
+    # a single file or a directory of PDFs, streamed through ingest_pdfs
+    collection = ingest_pdfs(pdf_path, collection_name)
     print(f"Stored chunks in ChromaDB collection: {collection_name}")
     
     return collection
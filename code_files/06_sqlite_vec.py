@@ -1,19 +1,57 @@
+import os
+import json
 import sqlite3
-from typing import Tuple, Optional, List, Any, Union, Iterable
+import time
+import queue
+import tempfile
+import threading
+from concurrent.futures import Future
+from functools import partial
+from itertools import islice
+from typing import Tuple, Optional, List, Any, Union, Iterable, Iterator, Dict, Sequence, Callable
+import numpy as np
 import sqlite_vec 
 from sqlite_vec import serialize_float32
+from flat_index import FlatIndex
+from embedding_executor import EmbeddingExecutor
+from hnsw_index import HNSWIndex
+from ivf_index import nearest_centroids, train_kmeans
+
+# metadata column types and the SQLite column types that store them
+METADATA_TYPES = {"integer": "INTEGER", "float": "REAL", "text": "TEXT", "boolean": "INTEGER"}
+
 
 class VectorDatabase:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, read_only: bool = False, check_same_thread: bool = True,
+                 pragmas: Optional[Dict[str, Any]] = None):
+        """
+        read_only opens the file with mode=ro, so the connection can query but never write
+        check_same_thread=False lets another thread close the connection, as ConnectionPool does
+        pragmas are set on every (re)connect, e.g. {"busy_timeout": 5000}
+        """
         self.db_path = db_path
+        self.read_only = read_only
+        self.check_same_thread = check_same_thread
+        self.pragmas = pragmas or {}
         self.connection: Optional[sqlite3.Connection] = None
+        self._flat_indexes: Dict[str, FlatIndex] = {}
+        self._hnsw_indexes: Dict[str, HNSWIndex] = {}
+        # (mtime, size) of each HNSW index file when it was loaded or saved through this connection
+        self._hnsw_stamps: Dict[str, Tuple[int, int]] = {}
         self._connect()
     
     def _connect(self) -> None:
-        self.connection = sqlite3.connect(self.db_path)
+        if self.read_only:
+            self.connection = sqlite3.connect(
+                f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=self.check_same_thread
+            )
+        else:
+            self.connection = sqlite3.connect(self.db_path, check_same_thread=self.check_same_thread)
         self.connection.enable_load_extension(True)
         sqlite_vec.load(self.connection)
         self.connection.enable_load_extension(False)
+        for pragma, value in self.pragmas.items():
+            self.connection.execute(f"PRAGMA {pragma}={value}")
     
     def get_versions(self) -> Tuple[str, str]:
         if not self.connection:
@@ -57,9 +95,104 @@ class VectorDatabase:
         cursor = self.execute(query, params)
         return cursor.fetchone()
     
-    def create_vector_table(self, table_name: str, dimensions: int) -> None:
-        self.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING vec0(embedding float[{dimensions}])")
+    def create_vector_table(self, table_name: str, dimensions: int, element_type: str = "float",
+                            backend: str = "vec0", metadata: Optional[Dict[str, str]] = None) -> None:
+        """
+        element_type is "float" (float32), "int8" or "bit"; see create_quantized_vector_table for the last two
+        backend "flat" stores float32 vectors in a memory-mapped FlatIndex next to the database file instead
+        of a vec0 table; the load and search functions below handle both
+        metadata maps column names to types, e.g. {"tenant": "text", "year": "integer"}; see create_metadata_table
+        """
+        if element_type not in ("float", "int8", "bit"):
+            raise ValueError(f"Unsupported element type: {element_type!r}")
+        if backend == "flat":
+            if element_type != "float":
+                raise ValueError("The flat backend only stores float vectors")
+            self._flat_indexes[table_name] = FlatIndex(self.flat_index_path(table_name), dimensions)
+        elif backend == "vec0":
+            self.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING vec0(embedding {element_type}[{dimensions}])")
+        else:
+            raise ValueError(f"Unsupported backend: {backend!r}")
+        if metadata:
+            self.create_metadata_table(table_name, metadata)
+
+    def create_metadata_table(self, table_name: str, columns: Dict[str, str]) -> None:
+        """
+        Typed metadata for a vector table, in a plain {table_name}_metadata table keyed by the vectors'
+        rowids, with a B-tree index per column so a filter can find its rows without touching the vectors.
+        Types are "integer", "float", "text" or "boolean"
+        """
+        definitions = []
+        for column, column_type in columns.items():
+            if not column.isidentifier():
+                raise ValueError(f"Invalid column name: {column!r}")
+            if column_type not in METADATA_TYPES:
+                raise ValueError(f"Unsupported metadata type for {column}: {column_type!r}")
+            definitions.append(f"{column} {METADATA_TYPES[column_type]}")
+        self.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name}_metadata(rowid INTEGER PRIMARY KEY, {', '.join(definitions)})"
+        )
+        for column in columns:
+            self.execute(
+                f"CREATE INDEX IF NOT EXISTS {table_name}_metadata_{column} ON {table_name}_metadata({column})"
+            )
+        self.commit()
+
+    def has_metadata(self, table_name: str) -> bool:
+        return self.execute_fetchone(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [f"{table_name}_metadata"]
+        ) is not None
     
+    def flat_index_path(self, table_name: str) -> str:
+        if self.db_path == ":memory:":
+            raise ValueError("The flat backend needs a database file to store its index next to")
+        return f"{self.db_path}.{table_name}.flat"
+
+    def flat_index(self, table_name: str) -> Optional[FlatIndex]:
+        """
+        :return: the table's FlatIndex if it was created with backend="flat", otherwise None
+        """
+        index = self._flat_indexes.get(table_name)
+        if index is None and self.db_path != ":memory:" and FlatIndex.exists(self.flat_index_path(table_name)):
+            index = self._flat_indexes[table_name] = FlatIndex(self.flat_index_path(table_name))
+        return index
+
+    def hnsw_index_path(self, table_name: str) -> Optional[str]:
+        # an in-memory database keeps its HNSW indexes in memory too
+        return None if self.db_path == ":memory:" else f"{self.db_path}.{table_name}.hnsw.npz"
+
+    def hnsw_index(self, table_name: str) -> Optional[HNSWIndex]:
+        """
+        :return: the table's secondary HNSW index, see build_hnsw_index, or None if it has none;
+        reloaded when another connection, e.g. a ConnectionPool's writer, has saved it since
+        """
+        index = self._hnsw_indexes.get(table_name)
+        path = self.hnsw_index_path(table_name)
+        if path is not None and os.path.exists(path):
+            stamp = self._hnsw_stamp(path)
+            if index is None or self._hnsw_stamps.get(table_name) != stamp:
+                index = self._hnsw_indexes[table_name] = HNSWIndex.load(path)
+                self._hnsw_stamps[table_name] = stamp
+        return index
+
+    @staticmethod
+    def _hnsw_stamp(path: str) -> Tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def set_hnsw_index(self, table_name: str, index: HNSWIndex) -> None:
+        self._hnsw_indexes[table_name] = index
+        self.save_hnsw_index(table_name)
+
+    def save_hnsw_index(self, table_name: str) -> None:
+        path = self.hnsw_index_path(table_name)
+        if path is not None and table_name in self._hnsw_indexes:
+            # written to the side and renamed, so a reader never loads a half-written file
+            temporary_path = f"{path}.tmp.npz"
+            self._hnsw_indexes[table_name].save(temporary_path)
+            os.replace(temporary_path, path)
+            self._hnsw_stamps[table_name] = self._hnsw_stamp(path)
+
     def commit(self) -> None:
         if self.connection:
             self.connection.commit()
@@ -78,13 +211,97 @@ class VectorDatabase:
         self.close()
 
 
+class ConnectionPool:
+    """
+    Shares one database file between threads, e.g. a FastAPI worker's thread pool:
+    every thread gets its own read-only connection for queries, and all writes go through
+    a queue to a single writer thread, so readers never wait on each other or on the writer.
+    The file is switched to WAL, which lets those readers run while a write is in progress
+    """
+
+    def __init__(self, db_path: str, busy_timeout_ms: int = 5000):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._readers: List[VectorDatabase] = []
+        self._readers_lock = threading.Lock()
+        self._writes: "queue.Queue[Optional[Tuple[Future, Any, tuple, dict]]]" = queue.Queue()
+
+        # opened here, before any reader, so the file exists and is already in WAL mode
+        self._writer = VectorDatabase(
+            db_path, check_same_thread=False, pragmas={"journal_mode": "WAL", "busy_timeout": busy_timeout_ms}
+        )
+        self._writer_thread = threading.Thread(target=self._write_loop, name="vector-db-writer", daemon=True)
+        self._writer_thread.start()
+
+    def reader(self) -> VectorDatabase:
+        """
+        :return: the calling thread's read-only connection, opened on first use
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = VectorDatabase(
+                self.db_path, read_only=True, check_same_thread=False, pragmas={"busy_timeout": self.busy_timeout_ms}
+            )
+            self._local.db = db
+            with self._readers_lock:
+                self._readers.append(db)
+        elif db.connection.in_transaction:
+            # a transaction left open by the last caller would pin its snapshot and hide later writes
+            db.connection.rollback()
+        return db
+
+    def write(self, func, *args, **kwargs) -> Future:
+        """
+        Queue func(writer_db, *args, **kwargs) for the writer thread, which commits after it returns
+        and rolls back if it raises, e.g. pool.write(bulk_load_vectors, "vec_data", items).result()
+        :return: a Future for func's result
+        """
+        future: Future = Future()
+        self._writes.put((future, func, args, kwargs))
+        return future
+
+    def _write_loop(self) -> None:
+        while True:
+            job = self._writes.get()
+            if job is None:
+                return
+            future, func, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(self._writer, *args, **kwargs)
+                self._writer.commit()
+            except BaseException as exc:
+                self._writer.connection.rollback()
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def close(self) -> None:
+        """
+        Finish the queued writes, then close the writer and every thread's reader
+        """
+        self._writes.put(None)
+        self._writer_thread.join()
+        self._writer.close()
+        with self._readers_lock:
+            for db in self._readers:
+                db.close()
+            self._readers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 # def serialize_float32(vector: List[float]) -> bytes:
 #     return struct.pack(f'{len(vector)}f', *vector)
 
 
-def find_similar_vectors(db: VectorDatabase, table_name: str, query_vector: List[float], limit: int = 3) -> List[tuple]:
-    return db.execute_fetchall(
-        f"""
+KNN_QUERY = """
         SELECT
           rowid,
           distance
@@ -92,20 +309,948 @@ def find_similar_vectors(db: VectorDatabase, table_name: str, query_vector: List
         WHERE embedding MATCH ?
         ORDER BY distance
         LIMIT ?
+        """
+
+
+def find_similar_vectors(
+    db: VectorDatabase,
+    table_name: str,
+    query_vector: Union[List[float], np.ndarray],
+    limit: int = 3,
+) -> Union[List[tuple], Tuple[np.ndarray, np.ndarray]]:
+    """
+    A list query gives a list of (rowid, distance) tuples.
+    A NumPy query is passed to sqlite as a float32 buffer and gives a pair of arrays (ids, distances);
+    a 2-D matrix of queries gives arrays of shape (n_queries, limit), padded with -1 / inf
+    """
+    index = db.flat_index(table_name)
+    if index is not None:
+        if not isinstance(query_vector, np.ndarray):
+            ids, distances = index.search(as_float32(query_vector), limit)
+            return [(int(i), float(d)) for i, d in zip(ids, distances) if i >= 0]
+        return index.search_batch(query_vector, limit) if np.ndim(query_vector) == 2 \
+            else index.search(query_vector, limit)
+
+    query = KNN_QUERY.format(table_name=table_name)
+    if not isinstance(query_vector, np.ndarray):
+        return db.execute_fetchall(query, [serialize_float32(query_vector), limit])
+
+    queries = as_float32(query_vector)
+    if queries.ndim == 1:
+        return rows_to_arrays(db.execute_fetchall(query, [queries, limit]), limit)
+    return find_similar_vectors_batch(db, table_name, queries, limit)
+
+
+FILTER_OPERATORS = {"=", "!=", "<", "<=", ">", ">="}
+
+
+def filter_clause(filters: Optional[Dict[str, Any]]) -> Tuple[str, list]:
+    """
+    Turn {"tenant": "acme", "year": (">=", 2020)} into " AND tenant = ? AND year >= ?" and its parameters.
+    The columns are those of the table's {table_name}_metadata table, see create_metadata_table
+    """
+    clauses, params = [], []
+    for column, condition in (filters or {}).items():
+        if not column.isidentifier():
+            raise ValueError(f"Invalid column name: {column!r}")
+        operator, value = condition if isinstance(condition, tuple) else ("=", condition)
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator: {operator!r}")
+        clauses.append(f" AND {column} {operator} ?")
+        params.append(value)
+    return "".join(clauses), params
+
+
+def find_similar_vectors_batch(
+    db: VectorDatabase,
+    table_name: str,
+    queries: np.ndarray,
+    k: int = 3,
+    filters: Optional[Dict[str, Any]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Run one KNN search per row of queries in a single SQL statement, by joining the rows of the
+    query matrix against the vec0 table, instead of one round-trip per query.
+    With filters, each query goes through find_similar_vectors_filtered, since the metadata
+    lives in the {table_name}_metadata table rather than in vec0
+    Returns (ids, distances) arrays of shape (n_queries, k), padded with -1 / inf
+    """
+    queries = as_float32(np.atleast_2d(queries))
+    ids = np.full((len(queries), k), -1, dtype=np.int64)
+    distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    if filters:
+        for position, query in enumerate(queries):
+            ids[position], distances[position] = find_similar_vectors_filtered(db, table_name, query, filters, k)
+        return ids, distances
+
+    index = db.flat_index(table_name)
+    if index is not None:
+        return index.search_batch(queries, k)
+    if len(queries) == 0:
+        return ids, distances
+
+    # The query matrix is bound as one float32 blob and sliced per query, so the search is a single
+    # read-only statement: no temp table to write, and no transaction left open on the connection
+    row_bytes = queries.shape[1] * 4
+    rows = db.execute_fetchall(
+        f"""
+        WITH RECURSIVE q(query_id) AS (SELECT 0 UNION ALL SELECT query_id + 1 FROM q WHERE query_id + 1 < ?)
+        SELECT q.query_id, v.rowid, v.distance
+        FROM q
+        JOIN {table_name} v ON v.embedding MATCH substr(?, q.query_id * ? + 1, ?) AND v.k = ?
+        ORDER BY q.query_id, v.distance
         """,
-        [serialize_float32(query_vector), limit]
+        [len(queries), queries, row_bytes, row_bytes, k]
     )
 
+    if rows:
+        query_ids, row_ids, row_distances = (np.asarray(column) for column in zip(*rows))
+        # position of each result within its query's (already sorted) results
+        positions = np.arange(len(query_ids)) - np.searchsorted(query_ids, query_ids)
+        ids[query_ids, positions] = row_ids
+        distances[query_ids, positions] = row_distances
+    return ids, distances
+
 
-def load_vectors(db: VectorDatabase, table_name: str, items: List[Tuple[int, List[float]]]) -> None:
-    serialized_items = [(item[0], serialize_float32(item[1])) for item in items]
+def load_vectors(
+    db: VectorDatabase,
+    table_name: str,
+    items: Union[List[Tuple[int, List[float]]], Tuple[np.ndarray, np.ndarray]],
+) -> None:
+    hnsw_index = db.hnsw_index(table_name)
+    index = db.flat_index(table_name)
+    if index is not None:
+        try:
+            load_flat_vectors(index, items, on_batch=partial(add_to_secondary_index, hnsw_index))
+        finally:
+            db.save_hnsw_index(table_name)
+        return
+
+    items = list(iter_items(items))
+    serialized_items = [(item_id, serialize_vector(vector)) for item_id, vector in items]
     
     with db:
-        for item_id, serialized_vector in serialized_items:
-            db.execute(
-                f"INSERT INTO {table_name}(rowid, embedding) VALUES (?, ?)",
-                [item_id, serialized_vector]
+        db.executemany(
+            f"INSERT INTO {table_name}(rowid, embedding) VALUES (?, ?)",
+            serialized_items
+        )
+    if hnsw_index is not None and items:
+        add_to_secondary_index(hnsw_index, [item_id for item_id, _ in items],
+                               np.stack([np.asarray(vector) for _, vector in items]))
+        db.save_hnsw_index(table_name)
+
+
+def as_float32(vectors: np.ndarray) -> np.ndarray:
+    # A no-op for arrays that are already C-contiguous float32, so sqlite reads their buffer directly
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+
+def serialize_vector(vector: Union[List[float], np.ndarray]) -> Union[bytes, np.ndarray]:
+    """
+    sqlite3 binds any object with the buffer protocol as a BLOB, so NumPy vectors
+    are passed as they are instead of being packed into a new bytes object
+    """
+    if isinstance(vector, np.ndarray):
+        return as_float32(vector)
+    return serialize_float32(vector)
+
+
+def rows_to_arrays(rows: List[tuple], limit: int) -> Tuple[np.ndarray, np.ndarray]:
+    ids = np.full(limit, -1, dtype=np.int64)
+    distances = np.full(limit, np.inf, dtype=np.float32)
+    if rows:
+        ids[:len(rows)], distances[:len(rows)] = zip(*rows)
+    return ids, distances
+
+
+def iter_items(items: Union[Iterable[Tuple[int, Any]], Tuple[np.ndarray, np.ndarray]]) -> Iterator[Tuple[int, Any]]:
+    """
+    Accept either (id, vector) pairs or a pair of NumPy arrays: ids of shape (n,) and vectors of shape (n, dims).
+    Rows of a float32 matrix are views into it, so they reach sqlite without a copy
+    """
+    if isinstance(items, tuple) and len(items) == 2 and isinstance(items[1], np.ndarray) and items[1].ndim == 2:
+        ids, vectors = items
+        return zip(np.asarray(ids).tolist(), as_float32(vectors))
+    return iter(items)
+
+
+def load_flat_vectors(
+    index: FlatIndex,
+    items: Union[Iterable[Tuple[int, Any]], Tuple[np.ndarray, np.ndarray]],
+    batch_size: int = 10_000,
+    on_batch: Optional[Callable[[List[int], np.ndarray], None]] = None,
+) -> int:
+    """
+    Append items to a flat-backend table, a batch at a time; a (ids, matrix) pair is appended in one go.
+    on_batch(ids, vectors) is called after each batch is appended
+    Returns the number of rows loaded
+    """
+    if isinstance(items, tuple) and len(items) == 2 and isinstance(items[1], np.ndarray) and items[1].ndim == 2:
+        index.add(np.asarray(items[0]), items[1])
+        if on_batch is not None:
+            on_batch(np.asarray(items[0]).tolist(), items[1])
+        return len(items[1])
+
+    rows = 0
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return rows
+        ids = [item_id for item_id, _ in batch]
+        vectors = np.stack([np.asarray(vector) for _, vector in batch])
+        index.add(ids, vectors)
+        if on_batch is not None:
+            on_batch(ids, vectors)
+        rows += len(batch)
+
+
+# Settings for a bulk load: bigger page cache, temp data in memory, and no fsync per transaction.
+# They are restored when the load ends
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "cache_size": -262144,  # 256 MB
+    "temp_store": "MEMORY",
+}
+
+
+def bulk_load_vectors(
+    db: VectorDatabase,
+    table_name: str,
+    items: Union[Iterable[Tuple[int, Any]], Tuple[np.ndarray, np.ndarray]],
+    batch_size: int = 10_000,
+    verbose: bool = True,
+    keep_wal: bool = False,
+) -> int:
+    """
+    Stream vectors into a vec0 table: serialize them a batch at a time and insert each batch
+    with executemany in its own transaction, so memory stays flat however many rows come in.
+    The pragmas in BULK_LOAD_PRAGMAS are restored afterwards; keep_wal leaves the file in WAL mode,
+    which persists in the file, as ConnectionPool needs
+    Returns the number of rows loaded
+    """
+    # the HNSW index, if any, gets each batch once it is committed, and is saved however the load ends
+    hnsw_index = db.hnsw_index(table_name)
+    index = db.flat_index(table_name)
+    if index is not None:
+        try:
+            return load_flat_vectors(index, items, batch_size, partial(add_to_secondary_index, hnsw_index))
+        finally:
+            db.save_hnsw_index(table_name)
+
+    insert_sql = f"INSERT INTO {table_name}(rowid, embedding) VALUES (?, ?)"
+    previous = {pragma: db.execute_fetchone(f"PRAGMA {pragma}")[0] for pragma in BULK_LOAD_PRAGMAS}
+    for pragma, value in BULK_LOAD_PRAGMAS.items():
+        db.execute(f"PRAGMA {pragma}={value}")
+
+    rows = 0
+    start = time.perf_counter()
+    iterator = iter_items(items)
+    try:
+        while True:
+            items_batch = list(islice(iterator, batch_size))
+            if not items_batch:
+                break
+            batch = [(item_id, serialize_vector(vector)) for item_id, vector in items_batch]
+            try:
+                db.executemany(insert_sql, batch)
+                db.commit()
+            except sqlite3.Error:
+                db.connection.rollback()
+                raise
+            add_to_secondary_index(hnsw_index, [item_id for item_id, _ in items_batch],
+                                   np.stack([np.asarray(vector) for _, vector in items_batch]))
+            rows += len(batch)
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print(f"Loaded {rows} rows into {table_name} ({rows / elapsed:,.0f} rows/sec)")
+    finally:
+        db.save_hnsw_index(table_name)
+        if keep_wal:
+            del previous["journal_mode"]
+        for pragma, value in previous.items():
+            db.execute(f"PRAGMA {pragma}={value}")
+
+    return rows
+
+
+def load_texts(
+    db: VectorDatabase,
+    table_name: str,
+    ids: Sequence[int],
+    texts: Sequence[str],
+    executor: EmbeddingExecutor,
+    batch_size: int = 10_000,
+    verbose: bool = True,
+) -> int:
+    """
+    Embed texts with the executor and stream the vectors into a table as they are computed,
+    so inserting one batch overlaps with the workers embedding the next ones
+    Returns the number of rows loaded
+    """
+    items = ((ids[position], vector) for position, vector in executor.iter_embeddings(texts))
+    return bulk_load_vectors(db, table_name, items, batch_size, verbose)
+
+
+class Quantizer:
+    """
+    Maps float32 vectors to int8 or bit vectors for a quantized vec0 table.
+    int8: subtract a per-dimension center, then divide by one global scale, so L2 order is kept
+    up to rounding. bit: the sign of each centered dimension, compared by Hamming distance
+    """
+
+    def __init__(self, kind: str, center: np.ndarray, scale: float = 1.0):
+        if kind not in ("int8", "bit"):
+            raise ValueError(f"Unsupported quantization: {kind!r}")
+        self.kind = kind
+        self.center = as_float32(center)
+        self.scale = scale
+
+    @classmethod
+    def calibrate(cls, kind: str, sample: np.ndarray, percentile: float = 99.9) -> "Quantizer":
+        """
+        Fit the quantizer to a sample of the vectors that will be stored
+        The int8 scale covers the given percentile of |x - center|, and rarer outliers are clipped
+        """
+        sample = as_float32(np.atleast_2d(sample))
+        center = sample.mean(axis=0)
+        scale = float(np.percentile(np.abs(sample - center), percentile)) / 127 or 1.0
+        return cls(kind, center, scale)
+
+    def quantize(self, vectors: np.ndarray) -> np.ndarray:
+        centered = as_float32(vectors) - self.center
+        if self.kind == "int8":
+            return np.clip(np.rint(centered / self.scale), -127, 127).astype(np.int8)
+        # vec0 bit vectors are little-endian within each byte
+        return np.packbits(centered > 0, axis=-1, bitorder="little")
+
+    @property
+    def sql_function(self) -> str:
+        # sqlite-vec needs to be told what type a BLOB holds
+        return "vec_int8" if self.kind == "int8" else "vec_bit"
+
+    def save(self, db: VectorDatabase, table_name: str) -> None:
+        db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name}_quantizer "
+            f"(id INTEGER PRIMARY KEY CHECK (id = 1), kind TEXT NOT NULL, center BLOB NOT NULL, scale REAL NOT NULL)"
+        )
+        db.execute(
+            f"INSERT OR REPLACE INTO {table_name}_quantizer(id, kind, center, scale) VALUES (1, ?, ?, ?)",
+            [self.kind, self.center, self.scale]
+        )
+
+    @classmethod
+    def load(cls, db: VectorDatabase, table_name: str) -> "Quantizer":
+        kind, center, scale = db.execute_fetchone(f"SELECT kind, center, scale FROM {table_name}_quantizer")
+        return cls(kind, np.frombuffer(center, dtype=np.float32), scale)
+
+
+def create_quantized_vector_table(db: VectorDatabase, table_name: str, sample: np.ndarray,
+                                  kind: str = "int8") -> Quantizer:
+    """
+    Create a quantized vec0 table for coarse search, plus a plain {table_name}_float32 table holding
+    the full-precision vectors for re-ranking. The quantizer is calibrated on sample and saved
+    alongside, so later loads and searches use the same mapping
+    """
+    quantizer = Quantizer.calibrate(kind, sample)
+    db.create_vector_table(table_name, quantizer.center.shape[0], element_type=kind)
+    db.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_float32(rowid INTEGER PRIMARY KEY, embedding BLOB NOT NULL)")
+    quantizer.save(db, table_name)
+    db.commit()
+    return quantizer
+
+
+def load_quantized_vectors(
+    db: VectorDatabase,
+    table_name: str,
+    items: Union[Iterable[Tuple[int, Any]], Tuple[np.ndarray, np.ndarray]],
+    batch_size: int = 10_000,
+) -> int:
+    """
+    Like bulk_load_vectors, writing each batch both quantized and at full precision
+    Returns the number of rows loaded
+    """
+    quantizer = Quantizer.load(db, table_name)
+    insert_quantized = f"INSERT INTO {table_name}(rowid, embedding) VALUES (?, {quantizer.sql_function}(?))"
+    insert_float = f"INSERT INTO {table_name}_float32(rowid, embedding) VALUES (?, ?)"
+
+    rows = 0
+    iterator = iter_items(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        ids = [item_id for item_id, _ in batch]
+        vectors = as_float32(np.stack([np.asarray(vector) for _, vector in batch]))
+        try:
+            db.executemany(insert_quantized, zip(ids, quantizer.quantize(vectors)))
+            db.executemany(insert_float, zip(ids, vectors))
+            db.commit()
+        except sqlite3.Error:
+            db.connection.rollback()
+            raise
+        rows += len(batch)
+    return rows
+
+
+def find_similar_vectors_quantized(
+    db: VectorDatabase,
+    table_name: str,
+    query_vector: np.ndarray,
+    limit: int = 3,
+    oversample: int = 10,
+    quantizer: Optional[Quantizer] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Two-stage search: a coarse KNN for limit * oversample candidates on the quantized table,
+    then an exact L2 re-rank of those candidates against their float32 vectors
+    Returns (ids, distances) arrays like find_similar_vectors does for NumPy queries
+    """
+    quantizer = quantizer or Quantizer.load(db, table_name)
+    query = as_float32(query_vector)
+    candidates = db.execute_fetchall(
+        f"""
+        SELECT rowid
+        FROM {table_name}
+        WHERE embedding MATCH {quantizer.sql_function}(?) AND k = ?
+        """,
+        [quantizer.quantize(query), limit * oversample]
+    )
+    if not candidates:
+        return rows_to_arrays([], limit)
+
+    candidate_ids = [row[0] for row in candidates]
+    placeholders = ",".join("?" * len(candidate_ids))
+    rows = db.execute_fetchall(
+        f"SELECT rowid, embedding FROM {table_name}_float32 WHERE rowid IN ({placeholders})", candidate_ids
+    )
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+    distances = np.linalg.norm(vectors - query, axis=1)
+    best = np.argsort(distances)[:limit]
+    return rows_to_arrays(list(zip(ids[best], distances[best])), limit)
+
+
+def export_embeddings(
+    db: VectorDatabase,
+    table_name: str,
+    path: str,
+    batch_size: int = 10_000,
+) -> Tuple[np.ndarray, np.memmap]:
+    """
+    Copy a float32 vector table into a .npy file a batch at a time and open it memory-mapped,
+    so all-pairs work reads the vectors from the page cache instead of holding them all in RAM
+    Returns (ids, matrix) where row i of matrix is the vector of ids[i]
+    """
+    count = db.execute_fetchone(f"SELECT COUNT(*) FROM {table_name}")[0]
+    first = db.execute_fetchone(f"SELECT embedding FROM {table_name} LIMIT 1")
+    dimensions = len(first[0]) // 4 if first else 0
+
+    ids = np.empty(count, dtype=np.int64)
+    matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(count, dimensions))
+    cursor = db.execute(f"SELECT rowid, embedding FROM {table_name} ORDER BY rowid")
+    position = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        end = position + len(rows)
+        ids[position:end] = [row[0] for row in rows]
+        matrix[position:end] = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        position = end
+    matrix.flush()
+    return ids, np.load(path, mmap_mode="r")
+
+
+PAIRWISE_METRICS = {"l2", "cosine", "dot"}
+
+
+def _prepare_metric(matrix: np.ndarray, metric: str) -> np.ndarray:
+    """
+    :return: the per-row values the distance needs besides the dot product:
+    squared norms for l2, norms for cosine, nothing for dot
+    """
+    if metric not in PAIRWISE_METRICS:
+        raise ValueError(f"Unsupported metric: {metric!r}")
+    squared = np.einsum("ij,ij->i", matrix, matrix) if metric != "dot" else np.zeros(len(matrix), np.float32)
+    return np.sqrt(squared) if metric == "cosine" else squared
+
+
+def _block_distances(rows: np.ndarray, columns: np.ndarray, row_norms: np.ndarray, column_norms: np.ndarray,
+                     metric: str) -> np.ndarray:
+    """
+    Distances between two blocks of vectors from one matrix product, with the same meaning as
+    vec_distance_l2 and vec_distance_cosine; "dot" is the negated inner product, so smaller is closer
+    """
+    products = np.asarray(rows) @ np.asarray(columns).T
+    if metric == "l2":
+        products *= -2
+        products += row_norms[:, None]
+        products += column_norms[None, :]
+        return np.sqrt(np.maximum(products, 0, out=products), out=products)
+    if metric == "cosine":
+        products /= np.maximum(np.outer(row_norms, column_norms), np.finfo(np.float32).tiny)
+        return np.subtract(1, products, out=products)
+    return np.negative(products, out=products)
+
+
+def pairwise_top_k(
+    matrix: np.ndarray,
+    k: int,
+    metric: str = "l2",
+    block_size: int = 2048,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The k nearest other rows of every row, working through block_size x block_size tiles
+    so memory stays at a few tiles however many rows there are
+    Returns (neighbours, distances) of shape (n, k), as row positions, padded with -1 / inf
+    """
+    count = len(matrix)
+    norms = _prepare_metric(matrix, metric)
+    neighbours = np.full((count, k), -1, dtype=np.int64)
+    distances = np.full((count, k), np.inf, dtype=np.float32)
+
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        rows = as_float32(matrix[start:stop])
+        best_ids = np.full((stop - start, k), -1, dtype=np.int64)
+        best = np.full((stop - start, k), np.inf, dtype=np.float32)
+        for column_start in range(0, count, block_size):
+            column_stop = min(column_start + block_size, count)
+            block = _block_distances(rows, matrix[column_start:column_stop], norms[start:stop],
+                                     norms[column_start:column_stop], metric)
+            if column_start == start:
+                np.fill_diagonal(block, np.inf)
+            # merge this tile's candidates into the running top k of each row
+            candidates = np.concatenate([best, block], axis=1)
+            candidate_ids = np.concatenate(
+                [best_ids, np.broadcast_to(np.arange(column_start, column_stop), block.shape)], axis=1
             )
+            keep = np.argpartition(candidates, k - 1, axis=1)[:, :k] if candidates.shape[1] > k \
+                else np.broadcast_to(np.arange(candidates.shape[1]), candidates.shape)
+            best = np.take_along_axis(candidates, keep, axis=1)
+            best_ids = np.take_along_axis(candidate_ids, keep, axis=1)
+
+        order = np.argsort(best, axis=1)
+        distances[start:stop] = np.take_along_axis(best, order, axis=1)
+        neighbours[start:stop] = np.where(np.isinf(distances[start:stop]), -1,
+                                          np.take_along_axis(best_ids, order, axis=1))
+    return neighbours, distances
+
+
+def pairwise_within(
+    matrix: np.ndarray,
+    threshold: float,
+    metric: str = "l2",
+    block_size: int = 2048,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Every pair of rows i < j at distance <= threshold, e.g. near-duplicates for dedup.
+    Only the tiles on or above the diagonal are computed, since the distances are symmetric
+    Returns (first, second, distances) arrays, with first and second as row positions
+    """
+    count = len(matrix)
+    norms = _prepare_metric(matrix, metric)
+    firsts, seconds, found = [], [], []
+
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        rows = as_float32(matrix[start:stop])
+        for column_start in range(start, count, block_size):
+            column_stop = min(column_start + block_size, count)
+            block = _block_distances(rows, matrix[column_start:column_stop], norms[start:stop],
+                                     norms[column_start:column_stop], metric)
+            close = block <= threshold
+            if column_start == start:
+                close = np.triu(close, k=1)
+            first, second = np.nonzero(close)
+            firsts.append(first + start)
+            seconds.append(second + column_start)
+            found.append(block[first, second])
+
+    if not firsts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(found)
+
+
+def find_similar_pairs(
+    db: VectorDatabase,
+    table_name: str,
+    path: str,
+    metric: str = "l2",
+    threshold: Optional[float] = None,
+    top_k: Optional[int] = None,
+    block_size: int = 2048,
+) -> Union[Tuple[np.ndarray, np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    All-pairs similarity over a vector table with NumPy, in place of a CROSS JOIN that calls
+    vec_distance_* once per pair. The table is exported to a memory-mapped file at path first
+    With threshold: returns (first_ids, second_ids, distances) for every pair within it
+    With top_k: returns (ids, neighbour_ids, distances), neighbour arrays of shape (n, top_k)
+    """
+    if (threshold is None) == (top_k is None):
+        raise ValueError("Pass exactly one of threshold and top_k")
+    ids, matrix = export_embeddings(db, table_name, path)
+    if top_k is not None:
+        neighbours, distances = pairwise_top_k(matrix, top_k, metric, block_size)
+        return ids, np.where(neighbours >= 0, ids[neighbours], -1), distances
+    first, second, distances = pairwise_within(matrix, threshold, metric, block_size)
+    return ids[first], ids[second], distances
+
+
+def iter_table_batches(db: VectorDatabase, table_name: str,
+                       batch_size: int = 10_000) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read every vector of a float32 table, vec0 or flat, as (ids, matrix) batches
+    """
+    index = db.flat_index(table_name)
+    if index is not None:
+        ids, vectors, _ = index._map()
+        for start in range(0, len(ids), batch_size):
+            yield np.array(ids[start:start + batch_size]), np.array(vectors[start:start + batch_size])
+        return
+
+    cursor = db.execute(f"SELECT rowid, embedding FROM {table_name} ORDER BY rowid")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield (np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+               np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1))
+
+
+def build_hnsw_index(
+    db: VectorDatabase,
+    table_name: str,
+    metric: str = "l2",
+    M: int = 16,
+    ef_construction: int = 200,
+    ef_search: int = 50,
+) -> HNSWIndex:
+    """
+    Build an HNSW graph over a table's vectors as a secondary index, saved next to the database file.
+    The table stays the source of truth: load_vectors, bulk_load_vectors and delete_vectors keep the
+    index in step, and find_similar_vectors_hnsw searches it instead of scanning the table
+    """
+    index = None
+    for ids, vectors in iter_table_batches(db, table_name):
+        if index is None:
+            index = HNSWIndex(vectors.shape[1], metric, M, ef_construction, ef_search)
+        index.add(ids, vectors)
+    if index is None:
+        raise ValueError(f"{table_name} is empty; load some vectors before building its index")
+    db.set_hnsw_index(table_name, index)
+    return index
+
+
+def add_to_secondary_index(index: Optional[HNSWIndex], ids: Sequence[int], vectors: np.ndarray) -> None:
+    """
+    Add a batch of rows to a table's HNSW index, if it has one. The loaders call this only once the batch
+    is committed, and save the index when they finish, so it never holds rows the table doesn't
+    """
+    if index is not None:
+        index.add(ids, as_float32(vectors))
+
+
+def delete_vectors(db: VectorDatabase, table_name: str, ids: Iterable[int]) -> int:
+    """
+    Delete rows from a vec0 table, and from its metadata and HNSW index if it has them
+    Returns the number of rows deleted from the table
+    """
+    if db.flat_index(table_name) is not None:
+        raise ValueError("The flat backend is append-only")
+    ids = [int(item_id) for item_id in ids]
+    cursor = db.executemany(f"DELETE FROM {table_name} WHERE rowid = ?", [(item_id,) for item_id in ids])
+    deleted = cursor.rowcount
+    if db.has_metadata(table_name):
+        db.executemany(f"DELETE FROM {table_name}_metadata WHERE rowid = ?", [(item_id,) for item_id in ids])
+    db.commit()
+    index = db.hnsw_index(table_name)
+    if index is not None:
+        index.delete(ids)
+        db.save_hnsw_index(table_name)
+    return deleted
+
+
+def find_similar_vectors_hnsw(
+    db: VectorDatabase,
+    table_name: str,
+    query_vector: Union[List[float], np.ndarray],
+    limit: int = 3,
+    ef_search: Optional[int] = None,
+) -> Union[List[tuple], Tuple[np.ndarray, np.ndarray]]:
+    """
+    Approximate nearest neighbours from the table's HNSW index, with the same return types as
+    find_similar_vectors; distances are in the index's metric. ef_search trades speed for recall
+    """
+    index = db.hnsw_index(table_name)
+    if index is None:
+        raise ValueError(f"{table_name} has no HNSW index; create one with build_hnsw_index")
+    if not isinstance(query_vector, np.ndarray):
+        ids, distances = index.search(as_float32(query_vector), limit, ef_search)
+        return [(int(i), float(d)) for i, d in zip(ids, distances) if i >= 0]
+    if query_vector.ndim == 2:
+        return index.search_batch(query_vector, limit, ef_search)
+    return index.search(query_vector, limit, ef_search)
+
+
+def create_ivf_vector_table(
+    db: VectorDatabase,
+    table_name: str,
+    sample: np.ndarray,
+    n_lists: int = 256,
+    iterations: int = 20,
+) -> np.ndarray:
+    """
+    Create an inverted-file (IVF) vec0 table: k-means centroids are trained on sample and every vector
+    is stored under the partition key of its nearest centroid, so a search only scans the partitions
+    near the query. Around sqrt(rows) lists is a good start, trained on some 50 vectors per list.
+    The centroids are kept in {table_name}_centroids. A table that already has centroids keeps them,
+    since its rows are stored under their partitions; sample is then ignored
+    Returns the centroids
+    """
+    db.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} "
+        f"USING vec0(partition_id integer partition key, embedding float[{sample.shape[1]}])"
+    )
+    db.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_centroids(partition_id INTEGER PRIMARY KEY, embedding BLOB NOT NULL)")
+    if db.execute_fetchone(f"SELECT 1 FROM {table_name}_centroids LIMIT 1") is not None:
+        db.commit()
+        return load_ivf_centroids(db, table_name)
+
+    centroids = train_kmeans(sample, n_lists, iterations)
+    db.executemany(f"INSERT INTO {table_name}_centroids(partition_id, embedding) VALUES (?, ?)", enumerate(centroids))
+    db.commit()
+    return centroids
+
+
+def load_ivf_centroids(db: VectorDatabase, table_name: str) -> np.ndarray:
+    rows = db.execute_fetchall(f"SELECT embedding FROM {table_name}_centroids ORDER BY partition_id")
+    return np.frombuffer(b"".join(row[0] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+
+
+def load_ivf_vectors(
+    db: VectorDatabase,
+    table_name: str,
+    items: Union[Iterable[Tuple[int, Any]], Tuple[np.ndarray, np.ndarray]],
+    batch_size: int = 10_000,
+    centroids: Optional[np.ndarray] = None,
+) -> int:
+    """
+    Like bulk_load_vectors, storing each vector in the partition of its nearest centroid
+    Returns the number of rows loaded
+    """
+    centroids = load_ivf_centroids(db, table_name) if centroids is None else centroids
+    insert_sql = f"INSERT INTO {table_name}(rowid, partition_id, embedding) VALUES (?, ?, ?)"
+
+    rows = 0
+    iterator = iter_items(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        vectors = as_float32(np.stack([np.asarray(vector) for _, vector in batch]))
+        partitions = nearest_centroids(vectors, centroids)[:, 0].tolist()
+        try:
+            db.executemany(insert_sql, zip((item_id for item_id, _ in batch), partitions, vectors))
+            db.commit()
+        except sqlite3.Error:
+            db.connection.rollback()
+            raise
+        rows += len(batch)
+    return rows
+
+
+def find_similar_vectors_ivf(
+    db: VectorDatabase,
+    table_name: str,
+    query_vector: np.ndarray,
+    limit: int = 3,
+    nprobe: int = 8,
+    centroids: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search only the nprobe partitions whose centroids are nearest to the query. vec0 runs the KNN
+    once per partition in the IN list, and the best limit of those results are kept.
+    More probes find more of the true neighbours and cost proportionally more
+    Returns (ids, distances) arrays, padded with -1 / inf
+    """
+    centroids = load_ivf_centroids(db, table_name) if centroids is None else centroids
+    query = as_float32(query_vector)
+    partitions = nearest_centroids(query, centroids, nprobe)[0].tolist()
+    rows = db.execute_fetchall(
+        f"""
+        SELECT rowid, distance
+        FROM {table_name}
+        WHERE embedding MATCH ? AND k = ? AND partition_id IN (SELECT value FROM json_each(?))
+        """,
+        [query, limit, json.dumps(partitions)]
+    )
+    # vec0 won't take a LIMIT next to k, even from an outer query, so the merge happens here
+    return rows_to_arrays(sorted(rows, key=lambda row: row[1])[:limit], limit)
+
+
+def load_metadata(
+    db: VectorDatabase,
+    table_name: str,
+    items: Iterable[Tuple[int, Dict[str, Any]]],
+    batch_size: int = 10_000,
+) -> int:
+    """
+    Insert or replace the metadata of (rowid, {column: value}) items, a batch at a time
+    Returns the number of rows written
+    """
+    rows = 0
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return rows
+        # one statement per distinct set of columns in the batch, usually just one
+        by_columns: Dict[Tuple[str, ...], list] = {}
+        for item_id, values in batch:
+            by_columns.setdefault(tuple(values), []).append((item_id, *values.values()))
+        try:
+            for columns, params in by_columns.items():
+                if not all(column.isidentifier() for column in columns):
+                    raise ValueError(f"Invalid column name in {columns!r}")
+                db.executemany(
+                    f"INSERT OR REPLACE INTO {table_name}_metadata(rowid, {', '.join(columns)}) "
+                    f"VALUES (?{', ?' * len(columns)})",
+                    params
+                )
+            db.commit()
+        except sqlite3.Error:
+            db.connection.rollback()
+            raise
+        rows += len(batch)
+
+
+def count_rows(db: VectorDatabase, table_name: str) -> int:
+    index = db.flat_index(table_name)
+    if index is not None:
+        return len(index)
+    # vec0 keeps one row per vector in its {table_name}_rowids shadow table; counting that is a quick
+    # B-tree count, where COUNT(*) on the virtual table reads every vector
+    return db.execute_fetchone(f"SELECT COUNT(*) FROM {table_name}_rowids")[0]
+
+
+# vec0 refuses KNN queries for more neighbours than this
+VEC0_MAX_K = 4096
+
+
+def l2_hnsw_index(db: VectorDatabase, table_name: str) -> Optional[HNSWIndex]:
+    """
+    :return: the table's HNSW index if it ranks by L2 distance, like vec0 and the flat backend, otherwise None
+    """
+    index = db.hnsw_index(table_name)
+    return index if index is not None and index.metric == "l2" else None
+
+
+def max_knn_k(db: VectorDatabase, table_name: str, total: int) -> int:
+    if db.flat_index(table_name) is not None or l2_hnsw_index(db, table_name) is not None:
+        return total
+    return min(total, VEC0_MAX_K)
+
+
+def post_filter_k(limit: int, matches: int, total: int) -> int:
+    # expect a matches / total share of the neighbours to pass the filter, and leave some headroom
+    return min(total, max(limit, int(np.ceil(2 * limit * total / max(matches, 1)))))
+
+
+def plan_filtered_search(
+    db: VectorDatabase,
+    table_name: str,
+    filters: Dict[str, Any],
+    limit: int = 3,
+    prefilter_selectivity: float = 0.02,
+) -> Tuple[str, int, int]:
+    """
+    Choose how to run a filtered search. The metadata indexes count the matching rows cheaply.
+    When at most prefilter_selectivity of the rows match, they are looked up and scored directly ("pre");
+    a point lookup costs some 40 times as much per row as vec0's scan, so past ~2% a KNN over the whole
+    table with a widened k, filtered afterwards, is cheaper ("post"). The planner also picks "pre" when
+    the filter is so selective that the k it needs is more than vec0 allows
+    Returns (plan, matching rows, total rows)
+    """
+    where, params = filter_clause(filters)
+    matches = db.execute_fetchone(f"SELECT COUNT(*) FROM {table_name}_metadata WHERE 1 = 1{where}", params)[0]
+    total = count_rows(db, table_name)
+    too_wide = post_filter_k(limit, matches, total) > max_knn_k(db, table_name, total)
+    plan = "pre" if matches <= prefilter_selectivity * total or too_wide else "post"
+    return plan, matches, total
+
+
+def fetch_vectors(db: VectorDatabase, table_name: str, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: (ids, vectors) of the given rows that exist, in no particular order
+    """
+    index = db.flat_index(table_name)
+    if index is not None:
+        all_ids, vectors, _ = index._map()
+        positions = np.flatnonzero(np.isin(all_ids, ids))
+        return np.asarray(all_ids[positions]), np.asarray(vectors[positions])
+
+    # vec0 answers rowid = ? with a point lookup, but scans the whole table for rowid IN (...)
+    found_ids, found = [], []
+    for item_id in ids:
+        row = db.execute_fetchone(f"SELECT rowid, embedding FROM {table_name} WHERE rowid = ?", [item_id])
+        if row is not None:
+            found_ids.append(row[0])
+            found.append(row[1])
+    return (np.asarray(found_ids, dtype=np.int64),
+            np.frombuffer(b"".join(found), dtype=np.float32).reshape(len(found_ids), -1))
+
+
+def find_similar_vectors_filtered(
+    db: VectorDatabase,
+    table_name: str,
+    query_vector: np.ndarray,
+    filters: Dict[str, Any],
+    limit: int = 3,
+    plan: Optional[str] = None,
+    prefilter_selectivity: float = 0.02,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Nearest neighbours among the rows whose metadata match filters, in the format of filter_clause.
+    plan forces "pre" or "post"; by default plan_filtered_search picks one. Both return L2 distances, exact
+    on vec0 and flat tables; with an L2 HNSW index the post-filter searches that instead, approximately
+    Returns (ids, distances) arrays, padded with -1 / inf
+    """
+    query = as_float32(query_vector)
+    chosen, matches, total = plan_filtered_search(db, table_name, filters, limit, prefilter_selectivity)
+    plan = plan or chosen
+    if matches == 0:
+        return rows_to_arrays([], limit)
+    where, params = filter_clause(filters)
+
+    if plan == "pre":
+        rows = db.execute_fetchall(f"SELECT rowid FROM {table_name}_metadata WHERE 1 = 1{where}", params)
+        ids, vectors = fetch_vectors(db, table_name, [row[0] for row in rows])
+        distances = np.linalg.norm(vectors - query, axis=1)
+        best = np.argsort(distances)[:limit]
+        return rows_to_arrays(list(zip(ids[best].tolist(), distances[best].tolist())), limit)
+    if plan != "post":
+        raise ValueError(f"Unsupported plan: {plan!r}")
+
+    # widen k whenever too few neighbours pass the filter; past what vec0 allows, score the matches directly
+    search = find_similar_vectors_hnsw if l2_hnsw_index(db, table_name) is not None else find_similar_vectors
+    max_k = max_knn_k(db, table_name, total)
+    k = min(max_k, post_filter_k(limit, matches, total))
+    while True:
+        ids, distances = search(db, table_name, query, k)
+        found = ids[ids >= 0].tolist()
+        passing = {row[0] for row in db.execute_fetchall(
+            f"SELECT rowid FROM {table_name}_metadata WHERE rowid IN (SELECT value FROM json_each(?)){where}",
+            [json.dumps(found), *params]
+        )}
+        keep = [i for i, item_id in enumerate(found) if item_id in passing][:limit]
+        if len(keep) == limit or k >= total:
+            return rows_to_arrays([(found[i], distances[i]) for i in keep], limit)
+        if k >= max_k:
+            return find_similar_vectors_filtered(db, table_name, query, filters, limit, "pre")
+        k = min(max_k, k * 4)
 
 
 def main():
@@ -145,22 +1290,16 @@ def main():
 
         print('\n\n'+"="*20 +"Distance Metrics" + "="*20)
         print("\nL2 (Euclidean Distance) and Cosine Distance:")
-        custom_results = db.execute_fetchall(
-            f"""
-            SELECT 
-                a.rowid AS vector1_id,
-                b.rowid AS vector2_id,
-                vec_distance_l2(a.embedding, b.embedding) AS l2_distance,
-                vec_distance_cosine(a.embedding, b.embedding) AS cosine_distance
-            FROM {table_name} a
-            CROSS JOIN {table_name} b
-            WHERE a.rowid < b.rowid
-            ORDER BY a.rowid, b.rowid
-            LIMIT 6
-            """
-        )
-        for row in custom_results:
-            print(row)
+        # all pairs with NumPy on a memory-mapped copy of the table, rather than a CROSS JOIN in SQL;
+        # the copy is exported once and both metrics are computed from it
+        with tempfile.TemporaryDirectory() as directory:
+            ids, matrix = export_embeddings(db, table_name, os.path.join(directory, f"{table_name}.npy"))
+            first, second, l2_distances = pairwise_within(matrix, np.inf, metric="l2")
+            _, _, cosine_distances = pairwise_within(matrix, np.inf, metric="cosine")
+            del matrix
+        order = np.lexsort((second, first))[:6]
+        for i in order:
+            print((int(ids[first[i]]), int(ids[second[i]]), float(l2_distances[i]), float(cosine_distances[i])))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,388 @@
+"""
+Benchmarks for the sqlite-vec helpers in 06_sqlite_vec.py, on random data in a throwaway database.
+
+    python bench_sqlite_vec.py batch --rows 100000 --dims 384 --queries 64
+    python bench_sqlite_vec.py quantized --rows 100000 --dims 384
+    python bench_sqlite_vec.py pairwise --rows 2000 --dims 384
+    python bench_sqlite_vec.py pool --rows 100000 --dims 384 --threads 1 2 4 8
+    python bench_sqlite_vec.py backends --sizes 10000 100000 1000000 --dims 384
+    python bench_sqlite_vec.py hnsw --rows 20000 --dims 128 --ef 10 20 50 100 200
+    python bench_sqlite_vec.py ivf --rows 200000 --dims 384 --lists 512 --nprobe 1 4 16 64
+    python bench_sqlite_vec.py filtered --rows 100000 --dims 384 --selectivity 0.001 0.01 0.1 0.5
+"""
+
+import argparse
+import importlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# the module name starts with a digit, so it can't be imported with a plain import statement
+sqlite_vec_demo = importlib.import_module("06_sqlite_vec")
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def random_vectors(rows: int, dims: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).random((rows, dims), dtype=np.float32)
+
+
+def clustered_vectors(rows: int, dims: int, clusters: int = 100, seed: int = 0) -> np.ndarray:
+    """
+    Gaussian blobs around random centers, closer to real embeddings than uniform noise.
+    The centers don't depend on seed, so queries drawn with another seed come from the same blobs
+    """
+    centers = np.random.default_rng(0).standard_normal((clusters, dims), dtype=np.float32)
+    rng = np.random.default_rng(seed + 1)
+    labels = rng.integers(0, clusters, rows)
+    return centers[labels] + 0.5 * rng.standard_normal((rows, dims), dtype=np.float32)
+
+
+def recall(found: np.ndarray, expected: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(f, e)) for f, e in zip(found, expected))
+    return hits / expected.size
+
+
+def file_size_mb(path: str) -> float:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p)) / 2 ** 20
+
+
+def build_table(db, table_name: str, vectors: np.ndarray) -> None:
+    db.create_vector_table(table_name, vectors.shape[1])
+    ids = np.arange(1, len(vectors) + 1)
+    _, seconds = timed(sqlite_vec_demo.bulk_load_vectors, db, table_name, (ids, vectors), verbose=False)
+    print(f"loaded {len(vectors):,} x {vectors.shape[1]} vectors in {seconds:.2f}s")
+
+
+def bench_batch(args) -> None:
+    """
+    find_similar_vectors_batch against a loop of find_similar_vectors calls
+    """
+    vectors = random_vectors(args.rows, args.dims)
+    queries = random_vectors(args.queries, args.dims, seed=1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        db = sqlite_vec_demo.VectorDatabase(os.path.join(folder, "bench.sqlite"))
+        build_table(db, "vec_bench", vectors)
+
+        def loop():
+            return [sqlite_vec_demo.find_similar_vectors(db, "vec_bench", query, args.k) for query in queries]
+
+        looped, loop_seconds = timed(loop)
+        (ids, _), batch_seconds = timed(sqlite_vec_demo.find_similar_vectors_batch, db, "vec_bench", queries, args.k)
+        db.close()
+
+    assert all((ids[i] == looped[i][0]).all() for i in range(len(queries))), "batch and loop disagree"
+    print(f"per-query loop: {loop_seconds * 1000:8.1f} ms  ({args.queries / loop_seconds:8.1f} queries/s)")
+    print(f"batched:        {batch_seconds * 1000:8.1f} ms  ({args.queries / batch_seconds:8.1f} queries/s)")
+
+
+def bench_quantized(args) -> None:
+    """
+    Recall, latency and size of int8 and bit tables with float32 re-ranking, against a float32 table
+    """
+    vectors = clustered_vectors(args.rows, args.dims)
+    queries = clustered_vectors(args.queries, args.dims, seed=1)
+    ids = np.arange(1, len(vectors) + 1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "float.sqlite")
+        db = sqlite_vec_demo.VectorDatabase(path)
+        build_table(db, "vec_bench", vectors)
+        (exact, _), seconds = timed(sqlite_vec_demo.find_similar_vectors_batch, db, "vec_bench", queries, args.k)
+        db.close()
+        print(f"{'float32':<8} recall@{args.k}=1.000  {seconds / len(queries) * 1000:7.2f} ms/query  "
+              f"{file_size_mb(path):8.1f} MB")
+
+        for kind in ("int8", "bit"):
+            path = os.path.join(folder, f"{kind}.sqlite")
+            db = sqlite_vec_demo.VectorDatabase(path)
+            quantizer = sqlite_vec_demo.create_quantized_vector_table(db, "vec_bench", vectors[:10_000], kind)
+            sqlite_vec_demo.load_quantized_vectors(db, "vec_bench", (ids, vectors))
+            size = file_size_mb(path)
+            float_size = db.execute_fetchone(
+                "SELECT SUM(LENGTH(embedding)) FROM vec_bench_float32")[0] / 2 ** 20
+
+            def search():
+                return np.stack([
+                    sqlite_vec_demo.find_similar_vectors_quantized(
+                        db, "vec_bench", query, args.k, args.oversample, quantizer)[0]
+                    for query in queries
+                ])
+
+            found, seconds = timed(search)
+            db.close()
+            print(f"{kind:<8} recall@{args.k}={recall(found, exact):.3f}  {seconds / len(queries) * 1000:7.2f} ms/query  "
+                  f"{size - float_size:8.1f} MB index + {float_size:.1f} MB float32 side table")
+
+
+def bench_pairwise(args) -> None:
+    """
+    All-pairs L2 distances: a CROSS JOIN calling vec_distance_l2 per pair, against find_similar_pairs
+    """
+    vectors = random_vectors(args.rows, args.dims)
+
+    with tempfile.TemporaryDirectory() as folder:
+        db = sqlite_vec_demo.VectorDatabase(os.path.join(folder, "bench.sqlite"))
+        build_table(db, "vec_bench", vectors)
+
+        cross_join, sql_seconds = timed(db.execute_fetchall, """
+            SELECT a.rowid, b.rowid, vec_distance_l2(a.embedding, b.embedding)
+            FROM vec_bench a
+            CROSS JOIN vec_bench b
+            WHERE a.rowid < b.rowid
+            """)
+        (first, second, distances), numpy_seconds = timed(
+            sqlite_vec_demo.find_similar_pairs, db, "vec_bench", os.path.join(folder, "vec_bench.npy"),
+            threshold=np.inf, block_size=args.block_size,
+        )
+        _, top_k_seconds = timed(
+            sqlite_vec_demo.find_similar_pairs, db, "vec_bench", os.path.join(folder, "vec_bench.npy"),
+            top_k=args.k, block_size=args.block_size,
+        )
+        db.close()
+
+    expected = np.array([row[2] for row in sorted(cross_join)], dtype=np.float32)
+    assert np.allclose(distances[np.lexsort((second, first))], expected, atol=1e-3), "CROSS JOIN and NumPy disagree"
+    print(f"CROSS JOIN:          {sql_seconds:8.2f} s  ({len(cross_join):,} pairs)")
+    print(f"find_similar_pairs:  {numpy_seconds:8.2f} s  (all pairs, threshold=inf)")
+    print(f"find_similar_pairs:  {top_k_seconds:8.2f} s  (top {args.k} per row)")
+
+
+def bench_pool(args) -> None:
+    """
+    KNN queries per second from several threads sharing a ConnectionPool, while the writer keeps ingesting
+    """
+    vectors = random_vectors(args.rows, args.dims)
+    queries = random_vectors(args.queries, args.dims, seed=1)
+    extra = random_vectors(args.rows // 10, args.dims, seed=2)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bench.sqlite")
+        with sqlite_vec_demo.VectorDatabase(path) as db:
+            build_table(db, "vec_bench", vectors)
+
+        with sqlite_vec_demo.ConnectionPool(path) as pool:
+            def search(query):
+                return sqlite_vec_demo.find_similar_vectors(pool.reader(), "vec_bench", query, args.k)
+
+            for threads in args.threads:
+                # keep the writer busy the whole time, in small transactions
+                next_id = args.rows + 1 + threads * len(extra)
+                ids = np.arange(next_id, next_id + len(extra))
+                ingest = pool.write(sqlite_vec_demo.bulk_load_vectors, "vec_bench", (ids, extra),
+                                    batch_size=1_000, verbose=False)
+                with ThreadPoolExecutor(threads) as executor:
+                    _, seconds = timed(lambda: list(executor.map(search, queries)))
+                ingest.result()
+                print(f"{threads:3d} threads: {len(queries) / seconds:8.1f} queries/s while ingesting")
+
+            # a reader that has already served queries must see a write committed after them
+            sqlite_vec_demo.find_similar_vectors_batch(pool.reader(), "vec_bench", queries[:2], args.k)
+            fresh_id = args.rows + 1 + (max(args.threads) + 1) * len(extra)
+            pool.write(sqlite_vec_demo.load_vectors, "vec_bench", [(fresh_id, queries[0])]).result()
+            ids, _ = sqlite_vec_demo.find_similar_vectors_batch(pool.reader(), "vec_bench", queries[:2], args.k)
+            assert ids[0, 0] == fresh_id, "the pooled reader missed a committed write"
+
+
+def bench_backends(args) -> None:
+    """
+    Load time and KNN latency of the vec0 and flat backends at several table sizes
+    """
+    queries = random_vectors(args.queries, args.dims, seed=1)
+
+    for rows in args.sizes:
+        vectors = random_vectors(rows, args.dims)
+        ids = np.arange(1, rows + 1)
+        results = {}
+        with tempfile.TemporaryDirectory() as folder:
+            db = sqlite_vec_demo.VectorDatabase(os.path.join(folder, "bench.sqlite"))
+            for backend in ("vec0", "flat"):
+                table_name = f"vec_{backend}"
+                db.create_vector_table(table_name, args.dims, backend=backend)
+                _, load_seconds = timed(sqlite_vec_demo.bulk_load_vectors, db, table_name, (ids, vectors),
+                                        verbose=False)
+
+                def loop():
+                    return [sqlite_vec_demo.find_similar_vectors(db, table_name, query, args.k) for query in queries]
+
+                results[backend], seconds = timed(loop)
+                print(f"{rows:>9,} rows  {backend:<5} load {load_seconds:7.2f} s   "
+                      f"{seconds / len(queries) * 1000:8.2f} ms/query")
+            db.close()
+
+        assert all((a[0] == b[0]).all() for a, b in zip(results["vec0"], results["flat"])), "backends disagree"
+
+
+def bench_hnsw(args) -> None:
+    """
+    Recall@k against queries per second for the HNSW index at several ef_search values, next to the exact scan
+    """
+    vectors = clustered_vectors(args.rows, args.dims)
+    queries = clustered_vectors(args.queries, args.dims, seed=1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        db = sqlite_vec_demo.VectorDatabase(os.path.join(folder, "bench.sqlite"))
+        build_table(db, "vec_bench", vectors)
+        (exact, _), seconds = timed(lambda: sqlite_vec_demo.find_similar_vectors_batch(db, "vec_bench", queries, args.k))
+        print(f"exact scan        recall@{args.k}=1.000  {len(queries) / seconds:8.1f} queries/s")
+
+        _, seconds = timed(sqlite_vec_demo.build_hnsw_index, db, "vec_bench", M=args.M,
+                           ef_construction=args.ef_construction)
+        print(f"built HNSW (M={args.M}, ef_construction={args.ef_construction}) in {seconds:.1f}s")
+        for ef in args.ef:
+            (found, _), seconds = timed(sqlite_vec_demo.find_similar_vectors_hnsw, db, "vec_bench", queries,
+                                        args.k, ef_search=ef)
+            print(f"hnsw ef={ef:<4}      recall@{args.k}={recall(found, exact):.3f}  {len(queries) / seconds:8.1f} queries/s")
+        db.close()
+
+
+def bench_ivf(args) -> None:
+    """
+    Recall@k and latency of an IVF table at several nprobe values, against a full vec0 scan
+    """
+    vectors = clustered_vectors(args.rows, args.dims, clusters=args.clusters)
+    queries = clustered_vectors(args.queries, args.dims, clusters=args.clusters, seed=1)
+    ids = np.arange(1, len(vectors) + 1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        db = sqlite_vec_demo.VectorDatabase(os.path.join(folder, "bench.sqlite"))
+        build_table(db, "vec_bench", vectors)
+        exact, seconds = timed(lambda: np.stack([
+            sqlite_vec_demo.find_similar_vectors(db, "vec_bench", query, args.k)[0] for query in queries
+        ]))
+        print(f"full scan     recall@{args.k}=1.000  {seconds / len(queries) * 1000:8.2f} ms/query")
+
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), min(len(vectors), 50 * args.lists), replace=False)]
+        centroids, seconds = timed(sqlite_vec_demo.create_ivf_vector_table, db, "vec_ivf", sample, args.lists)
+        _, load_seconds = timed(sqlite_vec_demo.load_ivf_vectors, db, "vec_ivf", (ids, vectors), centroids=centroids)
+        print(f"trained {args.lists} lists in {seconds:.1f}s, loaded in {load_seconds:.1f}s")
+        for nprobe in args.nprobe:
+            found, seconds = timed(lambda: np.stack([
+                sqlite_vec_demo.find_similar_vectors_ivf(db, "vec_ivf", query, args.k, nprobe, centroids)[0]
+                for query in queries
+            ]))
+            print(f"ivf nprobe={nprobe:<3} recall@{args.k}={recall(found, exact):.3f}  "
+                  f"{seconds / len(queries) * 1000:8.2f} ms/query")
+        db.close()
+
+
+def bench_filtered(args) -> None:
+    """
+    Filtered search latency and recall by filter selectivity, for the pre-filter, the post-filter
+    and the plan the planner picks
+    """
+    vectors = random_vectors(args.rows, args.dims)
+    queries = random_vectors(args.queries, args.dims, seed=1)
+    buckets = np.random.default_rng(2).integers(0, 1000, args.rows)
+
+    with tempfile.TemporaryDirectory() as folder:
+        db = sqlite_vec_demo.VectorDatabase(os.path.join(folder, "bench.sqlite"))
+        db.create_vector_table("vec_bench", args.dims, metadata={"bucket": "integer"})
+        build_table(db, "vec_bench", vectors)
+        sqlite_vec_demo.load_metadata(db, "vec_bench", ((i + 1, {"bucket": int(bucket)})
+                                                        for i, bucket in enumerate(buckets)))
+
+        for selectivity in args.selectivity:
+            filters = {"bucket": ("<", int(selectivity * 1000))}
+            matching = buckets < int(selectivity * 1000)
+            expected = []
+            for query in queries:
+                distances = np.linalg.norm(vectors - query, axis=1)
+                distances[~matching] = np.inf
+                expected.append(np.argsort(distances)[:args.k] + 1)
+
+            chosen = sqlite_vec_demo.plan_filtered_search(db, "vec_bench", filters, args.k)[0]
+            line = f"selectivity {selectivity:<6} planner={chosen:<4}"
+            for plan in ("pre", "post", None):
+                found, seconds = timed(lambda: np.stack([
+                    sqlite_vec_demo.find_similar_vectors_filtered(db, "vec_bench", query, filters, args.k, plan)[0]
+                    for query in queries
+                ]))
+                line += f"  {plan or 'auto'}: {seconds / len(queries) * 1000:7.1f} ms recall={recall(found, np.stack(expected)):.2f}"
+            print(line)
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch = commands.add_parser("batch", help="batched multi-query KNN vs a per-query loop")
+    batch.add_argument("--rows", type=int, default=100_000)
+    batch.add_argument("--dims", type=int, default=384)
+    batch.add_argument("--queries", type=int, default=64)
+    batch.add_argument("--k", type=int, default=10)
+    batch.set_defaults(run=bench_batch)
+
+    quantized = commands.add_parser("quantized", help="int8 / bit tables with re-ranking vs float32")
+    quantized.add_argument("--rows", type=int, default=100_000)
+    quantized.add_argument("--dims", type=int, default=384)
+    quantized.add_argument("--queries", type=int, default=32)
+    quantized.add_argument("--k", type=int, default=10)
+    quantized.add_argument("--oversample", type=int, default=10)
+    quantized.set_defaults(run=bench_quantized)
+
+    pairwise = commands.add_parser("pairwise", help="all-pairs distances with NumPy vs a SQL CROSS JOIN")
+    pairwise.add_argument("--rows", type=int, default=2_000)
+    pairwise.add_argument("--dims", type=int, default=384)
+    pairwise.add_argument("--k", type=int, default=10)
+    pairwise.add_argument("--block-size", type=int, default=2048)
+    pairwise.set_defaults(run=bench_pairwise)
+
+    pool = commands.add_parser("pool", help="concurrent KNN readers on a ConnectionPool during ingestion")
+    pool.add_argument("--rows", type=int, default=100_000)
+    pool.add_argument("--dims", type=int, default=384)
+    pool.add_argument("--queries", type=int, default=64)
+    pool.add_argument("--k", type=int, default=10)
+    pool.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    pool.set_defaults(run=bench_pool)
+
+    backends = commands.add_parser("backends", help="vec0 vs the memory-mapped flat backend by table size")
+    backends.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    backends.add_argument("--dims", type=int, default=384)
+    backends.add_argument("--queries", type=int, default=16)
+    backends.add_argument("--k", type=int, default=10)
+    backends.set_defaults(run=bench_backends)
+
+    hnsw = commands.add_parser("hnsw", help="HNSW recall vs queries/s against the exact scan")
+    hnsw.add_argument("--rows", type=int, default=20_000)
+    hnsw.add_argument("--dims", type=int, default=128)
+    hnsw.add_argument("--queries", type=int, default=200)
+    hnsw.add_argument("--k", type=int, default=10)
+    hnsw.add_argument("--M", type=int, default=16)
+    hnsw.add_argument("--ef-construction", type=int, default=100)
+    hnsw.add_argument("--ef", type=int, nargs="+", default=[10, 20, 50, 100, 200])
+    hnsw.set_defaults(run=bench_hnsw)
+
+    ivf = commands.add_parser("ivf", help="IVF partition pruning vs a full scan")
+    ivf.add_argument("--rows", type=int, default=200_000)
+    ivf.add_argument("--dims", type=int, default=384)
+    ivf.add_argument("--clusters", type=int, default=1_000, help="blobs in the generated data")
+    ivf.add_argument("--queries", type=int, default=32)
+    ivf.add_argument("--k", type=int, default=10)
+    ivf.add_argument("--lists", type=int, default=512)
+    ivf.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    ivf.set_defaults(run=bench_ivf)
+
+    filtered = commands.add_parser("filtered", help="metadata-filtered search by selectivity")
+    filtered.add_argument("--rows", type=int, default=100_000)
+    filtered.add_argument("--dims", type=int, default=384)
+    filtered.add_argument("--queries", type=int, default=16)
+    filtered.add_argument("--k", type=int, default=10)
+    filtered.add_argument("--selectivity", type=float, nargs="+", default=[0.001, 0.01, 0.1, 0.5])
+    filtered.set_defaults(run=bench_filtered)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
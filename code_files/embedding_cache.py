@@ -0,0 +1,212 @@
+"""
+A persistent, content-addressed cache of embeddings, shared by every place that embeds text:
+the Chroma loaders in 01_chroma_intro.py, the Medium article search notebook and the sqlite-vec loaders.
+
+Vectors are stored as float32 BLOBs in SQLite, keyed by (model name, sha256 of the text), so the same
+text embedded by the same model is only ever computed once, across runs and across processes.
+When the stored vectors grow past max_bytes, the least recently used ones are evicted. The total size
+is kept in the database by triggers, so every process sharing the file sees the same one, and reads
+never write: the times of cache hits are remembered and saved with the next put_many.
+
+    cache = EmbeddingCache("embeddings.sqlite")
+    embedding_function = CachedEmbeddingFunction(SentenceTransformerEmbeddingFunction(model_name=...), cache)
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str = "embeddings.sqlite", max_bytes: int = 2 * 1024 ** 3):
+        """
+        :param path: the SQLite file to keep the vectors in
+        :param max_bytes: the total size of stored vectors to evict down to
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # last use of each vector read since the last put_many, by (model, text_hash)
+        self._used: Dict[Tuple[str, bytes], float] = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # in one transaction, so another process can't add rows between the triggers and the initial total
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash BLOB NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_size(id INTEGER PRIMARY KEY CHECK (id = 1), bytes INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "INSERT OR IGNORE INTO cache_size(id, bytes) SELECT 1, COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        )
+        self.connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_inserted AFTER INSERT ON embeddings "
+            "BEGIN UPDATE cache_size SET bytes = bytes + LENGTH(NEW.vector); END"
+        )
+        self.connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_updated AFTER UPDATE OF vector ON embeddings "
+            "BEGIN UPDATE cache_size SET bytes = bytes + LENGTH(NEW.vector) - LENGTH(OLD.vector); END"
+        )
+        self.connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_deleted AFTER DELETE ON embeddings "
+            "BEGIN UPDATE cache_size SET bytes = bytes - LENGTH(OLD.vector); END"
+        )
+        self.connection.commit()
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingCache":
+        return cls(
+            path=os.getenv("EMBEDDING_CACHE_PATH", "embeddings.sqlite"),
+            max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 2 * 1024 ** 3)),
+        )
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        :return: the cached vector of each text, or None where there is none
+        """
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[bytes, np.ndarray] = {}
+        with self._lock:
+            # stay under SQLite's limit on the number of bound parameters
+            for start in range(0, len(hashes), 500):
+                part = hashes[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(part))})",
+                    [model, *part]
+                ).fetchall()
+                found.update((row[0], np.frombuffer(row[1], dtype=np.float32)) for row in rows)
+            now = time.time()
+            self._used.update(((model, text_hash), now) for text_hash in found)
+            vectors = [found.get(text_hash) for text_hash in hashes]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Any]) -> None:
+        now = time.time()
+        rows = [(model, text_hash(text), np.ascontiguousarray(vector, dtype=np.float32).tobytes(), now)
+                for text, vector in zip(texts, vectors)]
+        # a text repeated within one call is stored once
+        rows = list({row[1]: row for row in rows}.values())
+        with self._lock:
+            self._save_used()
+            # an upsert rather than INSERT OR REPLACE, whose implicit delete wouldn't fire the size trigger
+            self.connection.executemany(
+                "INSERT INTO embeddings(model, text_hash, vector, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(model, text_hash) DO UPDATE SET vector = excluded.vector, last_used = excluded.last_used",
+                rows
+            )
+            if self._stored_bytes() > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _save_used(self) -> None:
+        # called with the lock held, inside the caller's write transaction
+        if self._used:
+            self.connection.executemany(
+                "UPDATE embeddings SET last_used = MAX(last_used, ?) WHERE model = ? AND text_hash = ?",
+                [(used, model, text_hash) for (model, text_hash), used in self._used.items()]
+            )
+            self._used.clear()
+
+    def _stored_bytes(self) -> int:
+        return self.connection.execute("SELECT bytes FROM cache_size").fetchone()[0]
+
+    def _evict(self) -> None:
+        # drop least recently used vectors until the cache is 10% under its limit, so evictions come in batches
+        target = int(self.max_bytes * 0.9)
+        stored_bytes = self._stored_bytes()
+        while stored_bytes > target:
+            rows = self.connection.execute(
+                "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                return
+            evicted, freed = [], 0
+            for rowid, size in rows:
+                evicted.append((rowid,))
+                freed += size
+                if stored_bytes - freed <= target:
+                    break
+            self.connection.executemany("DELETE FROM embeddings WHERE rowid = ?", evicted)
+            stored_bytes = self._stored_bytes()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            stored_bytes = self._stored_bytes()
+        return {
+            "entries": entries,
+            "stored_bytes": stored_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._save_used()
+            self.connection.commit()
+            self.connection.close()
+
+
+def model_name_of(embedding_function: Any) -> str:
+    """
+    A name for the model behind an embedding function, to key its vectors by;
+    pass model_name to CachedEmbeddingFunction when the function doesn't expose one
+    """
+    for attribute in ("model_name", "_model_name", "MODEL_NAME"):
+        name = getattr(embedding_function, attribute, None)
+        if isinstance(name, str):
+            return name
+    return type(embedding_function).__name__
+
+
+class CachedEmbeddingFunction:
+    """
+    Wraps any embedding function that maps a list of texts to a list of vectors, e.g. a Chroma
+    embedding function, and only calls it for texts whose vectors aren't cached yet.
+    Like Chroma's embedding functions it is called with input=, so it can be passed to
+    get_or_create_collection as it is
+    """
+
+    def __init__(self, embedding_function: Callable[[List[str]], Sequence[Any]],
+                 cache: Optional[EmbeddingCache] = None, model_name: Optional[str] = None):
+        self.embedding_function = embedding_function
+        self.cache = cache or EmbeddingCache.from_env()
+        self.model_name = model_name or model_name_of(embedding_function)
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        texts = list(input)
+        vectors = self.cache.get_many(self.model_name, texts)
+        # each distinct missing text is embedded once, however often it repeats in the input
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = [np.asarray(vector, dtype=np.float32) for vector in self.embedding_function(missing)]
+            self.cache.put_many(self.model_name, missing, computed)
+            by_text = dict(zip(missing, computed))
+            vectors = [by_text[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        :return: the vectors as one (len(texts), dimensions) float32 matrix, ready for bulk_load_vectors
+        """
+        vectors = self(texts)
+        return np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
@@ -0,0 +1,198 @@
+"""
+Embed large numbers of texts in parallel on CPU-only hosts, for the Chroma and sqlite-vec loaders.
+
+Texts are sorted by length, longest first, and cut into batches whose padded size (batch size times the
+longest text in the batch) fits a memory budget. That way short texts never get padded to the length of a
+long one, and batches of short titles hold hundreds of texts. Batches run on a pool of workers: with a
+factory, each worker process builds its own model; without one, threads share the embedding function.
+At most a few batches are in flight ahead of the caller, so the caller's DB writes overlap with inference.
+
+    with EmbeddingExecutor(factory=partial(SentenceTransformerEmbeddingFunction, model_name=...)) as executor:
+        for positions, vectors in executor.map(texts):
+            collection.add(ids=[ids[i] for i in positions], embeddings=vectors.tolist(), ...)
+"""
+
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+EmbeddingFunction = Callable[[List[str]], Sequence[Any]]
+
+
+def estimate_tokens(text: str) -> int:
+    # about four characters per token for English with a WordPiece or BPE vocabulary, plus [CLS] and [SEP]
+    return len(text) // 4 + 2
+
+
+def embed_batch(embedding_function: EmbeddingFunction, texts: List[str]) -> np.ndarray:
+    """
+    :return: the (len(texts), dimensions) float32 embeddings; a batch that runs out of memory is split in half
+    """
+    try:
+        return np.asarray(embedding_function(texts), dtype=np.float32)
+    except MemoryError:
+        if len(texts) == 1:
+            raise
+        middle = len(texts) // 2
+        return np.concatenate([embed_batch(embedding_function, texts[:middle]),
+                               embed_batch(embedding_function, texts[middle:])])
+
+
+# the embedding function of a worker process, built once by _init_worker
+_worker_function: Optional[EmbeddingFunction] = None
+
+
+def _init_worker(factory: Callable[[], EmbeddingFunction], threads: int) -> None:
+    global _worker_function
+    # split the cores between the workers instead of every worker's math library using all of them
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_function = factory()
+
+
+def _embed_in_worker(texts: List[str]) -> np.ndarray:
+    return embed_batch(_worker_function, texts)
+
+
+class EmbeddingExecutor:
+    def __init__(self, embedding_function: Optional[EmbeddingFunction] = None,
+                 factory: Optional[Callable[[], EmbeddingFunction]] = None,
+                 workers: Optional[int] = None,
+                 memory_budget_mb: int = 512,
+                 bytes_per_token: int = 64 * 1024,
+                 max_batch_size: int = 512,
+                 count_tokens: Callable[[str], int] = estimate_tokens,
+                 max_tokens_per_text: int = 256,
+                 cache: Optional[EmbeddingCache] = None,
+                 model_name: Optional[str] = None,
+                 start_method: str = "spawn"):
+        """
+        :param embedding_function: called from worker threads; it must be thread-safe (PyTorch models are)
+        :param factory: a picklable callable that builds the embedding function, e.g. a functools.partial
+        of a Chroma embedding function class; given one, every worker process builds its own model
+        :param workers: defaults to one per core
+        :param memory_budget_mb: memory for the activations of all batches that run at once
+        :param bytes_per_token: rough activation memory per padded token; measure it for a big model
+        :param count_tokens: the token count of a text; estimate_tokens, or len(tokenizer.tokenize(text))
+        :param max_tokens_per_text: the model's max sequence length; longer texts are truncated to it
+        :param cache: embeddings already in the cache are served from it and never sent to a worker
+        :param model_name: the model the cached vectors are keyed by, required with a cache
+        """
+        if (embedding_function is None) == (factory is None):
+            raise ValueError("Pass either an embedding_function or a factory")
+        if cache is not None and model_name is None:
+            raise ValueError("A cache needs the model_name its vectors are keyed by")
+        self.workers = workers or os.cpu_count() or 1
+        # every worker runs one batch at a time, so each batch gets its share of the budget
+        self.max_batch_tokens = max(1, memory_budget_mb * 1024 * 1024 // bytes_per_token // self.workers)
+        self.max_batch_size = max_batch_size
+        self.count_tokens = count_tokens
+        self.max_tokens_per_text = max_tokens_per_text
+        self.cache = cache
+        self.model_name = model_name
+        self.embedding_function = embedding_function
+        self.pool: Executor
+        if factory is not None:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(start_method),
+                                            initializer=_init_worker, initargs=(factory, threads))
+        else:
+            self.pool = ThreadPoolExecutor(self.workers)
+
+    def plan_batches(self, texts: Sequence[str]) -> List[List[int]]:
+        """
+        :return: batches of positions into texts, longest texts first, each within max_batch_tokens
+        once padded to its longest text; a text over the budget on its own gets a batch of its own
+        """
+        tokens = [min(self.count_tokens(text), self.max_tokens_per_text) for text in texts]
+        order = sorted(range(len(texts)), key=tokens.__getitem__, reverse=True)
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        padded_length = 0
+        for position in order:
+            # sorted longest first, so the first text of a batch sets its padded length
+            if batch and ((len(batch) + 1) * padded_length > self.max_batch_tokens or len(batch) == self.max_batch_size):
+                batches.append(batch)
+                batch = []
+            if not batch:
+                padded_length = tokens[position]
+            batch.append(position)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _submit(self, texts: List[str]) -> Future:
+        if self.embedding_function is not None:
+            return self.pool.submit(embed_batch, self.embedding_function, texts)
+        return self.pool.submit(_embed_in_worker, texts)
+
+    def map(self, texts: Sequence[str], max_pending: Optional[int] = None) -> Iterator[Tuple[List[int], np.ndarray]]:
+        """
+        Yield (positions, vectors) a batch at a time, in the order the batches were planned rather than
+        the order of texts; vectors[i] is the embedding of texts[positions[i]].
+        At most max_pending batches (two per worker by default) run ahead of the caller, so whatever
+        the caller does with a batch, such as writing it to a DB, overlaps with embedding the next ones
+        """
+        max_pending = max_pending or 2 * self.workers
+        positions = range(len(texts))
+        if self.cache is not None:
+            cached = self.cache.get_many(self.model_name, texts)
+            hits = [position for position in positions if cached[position] is not None]
+            for start in range(0, len(hits), self.max_batch_size):
+                batch = hits[start:start + self.max_batch_size]
+                yield batch, np.stack([cached[position] for position in batch])
+            positions = [position for position in positions if cached[position] is None]
+            del cached
+
+        pending: Deque[Tuple[List[int], Future]] = deque()
+        for batch in self.plan_batches([texts[position] for position in positions]):
+            batch = [positions[index] for index in batch]
+            pending.append((batch, self._submit([texts[position] for position in batch])))
+            if len(pending) >= max_pending:
+                yield self._finished(pending.popleft(), texts)
+        while pending:
+            yield self._finished(pending.popleft(), texts)
+
+    def _finished(self, task: Tuple[List[int], Future], texts: Sequence[str]) -> Tuple[List[int], np.ndarray]:
+        batch, future = task
+        vectors = future.result()
+        if self.cache is not None:
+            self.cache.put_many(self.model_name, [texts[position] for position in batch], vectors)
+        return batch, vectors
+
+    def iter_embeddings(self, texts: Sequence[str]) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Yield (position, vector) pairs, e.g. to stream into bulk_load_vectors
+        """
+        for batch, vectors in self.map(texts):
+            yield from zip(batch, vectors)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        :return: the (len(texts), dimensions) embeddings, in the order of texts
+        """
+        matrix: Optional[np.ndarray] = None
+        for batch, vectors in self.map(texts):
+            if matrix is None:
+                matrix = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            matrix[batch] = vectors
+        return matrix if matrix is not None else np.empty((0, 0), dtype=np.float32)
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+    def __enter__(self) -> "EmbeddingExecutor":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
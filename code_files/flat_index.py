@@ -0,0 +1,141 @@
+"""
+A flat (exact) vector index stored as append-only files that are scanned memory-mapped with NumPy.
+For up to a few million vectors, a blocked matrix-vector product over one contiguous float32 matrix
+is usually faster than vec0's row-by-row scan, and it needs no SQLite at all.
+
+Layout of an index directory:
+    meta.json     {"dimensions": 384}
+    vectors.f32   row-major float32 vectors
+    norms.f32     the squared L2 norm of each vector, so a search only needs the dot products
+    ids.i64       the id of each row, written last so a half-written append is ignored on open
+"""
+
+import os
+import json
+from typing import Iterable, Optional, Tuple
+import numpy as np
+
+
+class FlatIndex:
+    def __init__(self, path: str, dimensions: Optional[int] = None, block_size: int = 262_144):
+        """
+        Open the index at path, creating it if dimensions is given and it doesn't exist yet
+        :param block_size: rows scanned per matrix-vector product; bounds the temporary memory of a search
+        """
+        self.path = path
+        self.block_size = block_size
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                self.dimensions = json.load(file)["dimensions"]
+            if dimensions is not None and dimensions != self.dimensions:
+                raise ValueError(f"{path} holds {self.dimensions}-dimensional vectors, not {dimensions}")
+        elif dimensions is None:
+            raise FileNotFoundError(f"No flat index at {path}")
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.dimensions = dimensions
+            with open(meta_path, "w") as file:
+                json.dump({"dimensions": dimensions}, file)
+        self._views: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def __len__(self) -> int:
+        ids_path = self._file("ids.i64")
+        return os.path.getsize(ids_path) // 8 if os.path.exists(ids_path) else 0
+
+    def add(self, ids: Iterable[int], vectors: np.ndarray) -> None:
+        """
+        Append vectors of shape (n, dimensions) with their ids; like a vec0 rowid, an id can only be added once
+        """
+        vectors = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+        ids = np.ascontiguousarray(np.fromiter(ids, dtype=np.int64) if not isinstance(ids, np.ndarray) else ids,
+                                   dtype=np.int64)
+        if vectors.shape != (len(ids), self.dimensions):
+            raise ValueError(f"Expected {len(ids)} vectors of {self.dimensions} dimensions, got {vectors.shape}")
+        unique = np.unique(ids)
+        if len(unique) != len(ids):
+            raise ValueError("Duplicate ids in the batch")
+        taken = unique[np.isin(unique, self._map()[0])]
+        if len(taken):
+            raise ValueError(f"Ids already in the index: {taken[:10].tolist()}")
+
+        count = len(self)
+        # drop any tail left by an append that died before its ids were written
+        for name, row_bytes in (("vectors.f32", 4 * self.dimensions), ("norms.f32", 4)):
+            with open(self._file(name), "ab") as file:
+                file.truncate(count * row_bytes)
+        with open(self._file("vectors.f32"), "ab") as file:
+            file.write(vectors.tobytes())
+        with open(self._file("norms.f32"), "ab") as file:
+            file.write(np.einsum("ij,ij->i", vectors, vectors).tobytes())
+        with open(self._file("ids.i64"), "ab") as file:
+            file.write(ids.tobytes())
+        self._views = None
+
+    def _map(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: memory-mapped (ids, vectors, norms), remapped only after an append
+        """
+        count = len(self)
+        if self._views is None or len(self._views[0]) != count:
+            if count == 0:
+                self._views = (np.empty(0, np.int64), np.empty((0, self.dimensions), np.float32),
+                               np.empty(0, np.float32))
+            else:
+                self._views = (
+                    np.memmap(self._file("ids.i64"), dtype=np.int64, mode="r", shape=(count,)),
+                    np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r", shape=(count, self.dimensions)),
+                    np.memmap(self._file("norms.f32"), dtype=np.float32, mode="r", shape=(count,)),
+                )
+        return self._views
+
+    def search(self, query: np.ndarray, k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (ids, distances) of the k nearest vectors by L2 distance, like vec0,
+        padded with -1 / inf when the index holds fewer than k vectors
+        """
+        ids, distances = self.search_batch(np.atleast_2d(query), k)
+        return ids[0], distances[0]
+
+    def search_batch(self, queries: np.ndarray, k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (ids, distances) arrays of shape (n_queries, k)
+        """
+        queries = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        row_ids, vectors, norms = self._map()
+        best = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+
+        for start in range(0, len(vectors), self.block_size):
+            stop = min(start + self.block_size, len(vectors))
+            # |x - q|^2 = |x|^2 - 2 x.q + |q|^2; |q|^2 is the same for every row, so it is added at the end
+            scores = vectors[start:stop] @ queries.T
+            scores *= -2
+            scores += norms[start:stop, None]
+            scores = scores.T
+            if scores.shape[1] > k:
+                top = np.argpartition(scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            candidates = np.concatenate([best, scores], axis=1)
+            candidate_rows = np.concatenate([best_rows, top + start], axis=1)
+            keep = np.argpartition(candidates, k - 1, axis=1)[:, :k]
+            best = np.take_along_axis(candidates, keep, axis=1)
+            best_rows = np.take_along_axis(candidate_rows, keep, axis=1)
+
+        order = np.argsort(best, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        found = best_rows >= 0
+        distances = np.where(found, np.sqrt(np.maximum(best + np.einsum("ij,ij->i", queries, queries)[:, None], 0)),
+                             np.inf).astype(np.float32)
+        ids = np.where(found, row_ids[np.maximum(best_rows, 0)] if len(row_ids) else -1, -1)
+        return ids, distances
@@ -0,0 +1,298 @@
+"""
+A Hierarchical Navigable Small World (HNSW) graph index in plain Python and NumPy,
+following Malkov & Yashunin, "Efficient and robust approximate nearest neighbor search
+using Hierarchical Navigable Small World graphs" (2016).
+
+Every vector is a node on level 0 and, with exponentially falling probability, on the levels above.
+A search greedily descends from the single entry point on the top level, then runs a best-first
+search with a candidate list of ef nodes on level 0. Distances to a node's neighbours are computed
+together in one NumPy call, so the Python overhead is per visited node rather than per distance.
+
+    M               links per node on the levels above 0 (2 * M on level 0); more links, better recall, more memory
+    ef_construction candidate list size while inserting; higher builds a better graph, more slowly
+    ef_search       candidate list size while searching; the recall / speed knob at query time
+"""
+
+import math
+import heapq
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+
+METRICS = {"l2", "cosine", "ip"}
+
+
+class HNSWIndex:
+    def __init__(self, dimensions: int, metric: str = "l2", M: int = 16, ef_construction: int = 200,
+                 ef_search: int = 50, seed: int = 0):
+        if metric not in METRICS:
+            raise ValueError(f"Unsupported metric: {metric!r}")
+        self.dimensions = dimensions
+        self.metric = metric
+        self.M = M
+        self.max_links = {0: 2 * M}
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_multiplier = 1 / math.log(M)
+        self.rng = np.random.default_rng(seed)
+
+        self.vectors = np.empty((1024, dimensions), dtype=np.float32)
+        self.norms = np.empty(1024, dtype=np.float32)
+        self.ids: List[int] = []
+        # links[node][level] is the list of the node's neighbours on that level
+        self.links: List[List[List[int]]] = []
+        self.node_of: Dict[int, int] = {}
+        self.deleted: Set[int] = set()
+        self.entry_point: Optional[int] = None
+        self.max_level = -1
+
+    def __len__(self) -> int:
+        return len(self.node_of)
+
+    # distances
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+        if vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Expected {self.dimensions}-dimensional vectors, got {vectors.shape[1]}")
+        if self.metric == "cosine":
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+        return vectors
+
+    def _distances(self, query: np.ndarray, nodes: List[int]) -> np.ndarray:
+        """
+        Distances that order nodes like the metric does: squared L2, 1 - cosine, or negated inner product
+        """
+        products = self.vectors[nodes] @ query
+        if self.metric == "l2":
+            return self.norms[nodes] - 2 * products + query @ query
+        if self.metric == "cosine":
+            return 1 - products
+        return -products
+
+    def _finish(self, distances: np.ndarray) -> np.ndarray:
+        # report L2 itself, like vec0 and FlatIndex, rather than its square
+        return np.sqrt(np.maximum(distances, 0)) if self.metric == "l2" else distances
+
+    # graph construction
+
+    def _search_layer(self, query: np.ndarray, entry_points: List[int], ef: int, level: int) -> List[Tuple[float, int]]:
+        """
+        Best-first search of one level
+        :return: up to ef (distance, node) pairs, nearest first
+        """
+        visited = set(entry_points)
+        distances = self._distances(query, entry_points).tolist()
+        candidates = list(zip(distances, entry_points))
+        heapq.heapify(candidates)
+        results = [(-distance, node) for distance, node in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            fresh = [neighbour for neighbour in self.links[node][level] if neighbour not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for neighbour_distance, neighbour in zip(self._distances(query, fresh).tolist(), fresh):
+                if len(results) < ef or neighbour_distance < -results[0][0]:
+                    heapq.heappush(candidates, (neighbour_distance, neighbour))
+                    heapq.heappush(results, (-neighbour_distance, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-distance, node) for distance, node in results)
+
+    def _select_neighbours(self, candidates: List[Tuple[float, int]], count: int) -> List[int]:
+        """
+        The paper's neighbour selection heuristic: take candidates nearest first, skipping any that is
+        closer to an already selected neighbour than to the new node, so links spread in all directions
+        """
+        if len(candidates) <= count:
+            return [node for _, node in candidates]
+        nodes = [node for _, node in candidates]
+        vectors = self.vectors[nodes]
+        products = vectors @ vectors.T
+        if self.metric == "l2":
+            norms = self.norms[nodes]
+            between = norms[:, None] + norms[None, :] - 2 * products
+        else:
+            between = 1 - products if self.metric == "cosine" else -products
+
+        # distance from each candidate to its nearest selected neighbour so far
+        nearest_selected = np.full(len(nodes), np.inf, dtype=np.float32)
+        selected: List[int] = []
+        for position, (distance, _) in enumerate(candidates):
+            if nearest_selected[position] < distance:
+                continue
+            selected.append(nodes[position])
+            if len(selected) == count:
+                break
+            np.minimum(nearest_selected, between[position], out=nearest_selected)
+        return selected
+
+    def _add_one(self, item_id: int, vector: np.ndarray) -> None:
+        node = len(self.ids)
+        if node == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+            self.norms = np.concatenate([self.norms, np.empty_like(self.norms)])
+        self.vectors[node] = vector
+        self.norms[node] = vector @ vector
+        self.ids.append(item_id)
+        level = int(-math.log(1 - self.rng.random()) * self.level_multiplier)
+        self.links.append([[] for _ in range(level + 1)])
+
+        if item_id in self.node_of:
+            # re-adding an id replaces its old vector
+            self.deleted.add(self.node_of[item_id])
+        self.node_of[item_id] = node
+
+        if self.entry_point is None:
+            self.entry_point, self.max_level = node, level
+            return
+
+        entry_points = [self.entry_point]
+        for current in range(self.max_level, level, -1):
+            entry_points = [self._search_layer(vector, entry_points, 1, current)[0][1]]
+        for current in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(vector, entry_points, self.ef_construction, current)
+            neighbours = self._select_neighbours(found, self.M)
+            self.links[node][current] = neighbours
+            max_links = self.max_links.get(current, self.M)
+            for neighbour in neighbours:
+                links = self.links[neighbour][current]
+                links.append(node)
+                if len(links) > max_links:
+                    distances = self._distances(self.vectors[neighbour], links).tolist()
+                    self.links[neighbour][current] = self._select_neighbours(sorted(zip(distances, links)), max_links)
+            entry_points = [node for _, node in found]
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def add(self, ids: Iterable[int], vectors: np.ndarray) -> None:
+        """
+        Insert vectors of shape (n, dimensions); an id that is already indexed gets its new vector
+        """
+        vectors = self._prepare(vectors)
+        ids = list(ids)
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+        for item_id, vector in zip(ids, vectors):
+            self._add_one(int(item_id), vector)
+
+    def delete(self, ids: Iterable[int]) -> int:
+        """
+        Mark ids as deleted. Their nodes stay in the graph as stepping stones, so its connectivity
+        is kept, but they are never returned; call compact() once many have piled up
+        :return: how many of the ids were indexed
+        """
+        removed = 0
+        for item_id in ids:
+            node = self.node_of.pop(int(item_id), None)
+            if node is not None:
+                self.deleted.add(node)
+                removed += 1
+        return removed
+
+    def compact(self) -> "HNSWIndex":
+        """
+        :return: a new index built from the live vectors only
+        """
+        index = HNSWIndex(self.dimensions, self.metric, self.M, self.ef_construction, self.ef_search)
+        nodes = sorted(self.node_of.values())
+        if nodes:
+            # the stored vectors are already normalised for cosine, which _prepare leaves unchanged
+            index.add([self.ids[node] for node in nodes], self.vectors[nodes])
+        return index
+
+    # queries
+
+    def search(self, query: np.ndarray, k: int = 3, ef_search: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (ids, distances) of the approximate k nearest vectors, padded with -1 / inf
+        """
+        ids = np.full(k, -1, dtype=np.int64)
+        distances = np.full(k, np.inf, dtype=np.float32)
+        if self.entry_point is None or not self.node_of:
+            return ids, distances
+
+        query = self._prepare(query)[0]
+        entry_points = [self.entry_point]
+        for current in range(self.max_level, 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, current)[0][1]]
+        ef = max(ef_search or self.ef_search, k)
+        while True:
+            found = [(distance, node) for distance, node in self._search_layer(query, entry_points, ef, 0)
+                     if node not in self.deleted][:k]
+            # deleted nodes take up room in the candidate list; widen it until k live ones fit
+            if len(found) == min(k, len(self.node_of)) or ef >= len(self.ids):
+                break
+            ef *= 2
+        if found:
+            found_distances, nodes = zip(*found)
+            ids[:len(nodes)] = [self.ids[node] for node in nodes]
+            distances[:len(nodes)] = self._finish(np.asarray(found_distances))
+        return ids, distances
+
+    def search_batch(self, queries: np.ndarray, k: int = 3,
+                     ef_search: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (ids, distances) arrays of shape (n_queries, k)
+        """
+        results = [self.search(query, k, ef_search) for query in np.atleast_2d(queries)]
+        if not results:
+            return np.empty((0, k), np.int64), np.empty((0, k), np.float32)
+        ids, distances = zip(*results)
+        return np.stack(ids), np.stack(distances)
+
+    # persistence
+
+    def save(self, path: str) -> None:
+        """
+        Write the index to one .npz file; the links of every node and level are flattened
+        into one array, with a count per (node, level) to split them again
+        """
+        counts = [len(level_links) for node_links in self.links for level_links in node_links]
+        flat_links = [neighbour for node_links in self.links for level_links in node_links for neighbour in level_links]
+        count = len(self.ids)
+        np.savez(
+            path,
+            settings=np.array([self.dimensions, self.M, self.ef_construction, self.ef_search,
+                               -1 if self.entry_point is None else self.entry_point, self.max_level], dtype=np.int64),
+            metric=np.array(self.metric),
+            vectors=self.vectors[:count],
+            ids=np.asarray(self.ids, dtype=np.int64),
+            levels=np.asarray([len(node_links) for node_links in self.links], dtype=np.int32),
+            counts=np.asarray(counts, dtype=np.int32),
+            links=np.asarray(flat_links, dtype=np.int32),
+            deleted=np.asarray(sorted(self.deleted), dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "HNSWIndex":
+        with np.load(path) as data:
+            dimensions, M, ef_construction, ef_search, entry_point, max_level = data["settings"].tolist()
+            index = cls(dimensions, str(data["metric"]), M, ef_construction, ef_search)
+            vectors = data["vectors"]
+            index.vectors = np.concatenate([vectors, np.empty((max(len(vectors), 1024), dimensions), np.float32)])
+            index.norms = np.concatenate([np.einsum("ij,ij->i", vectors, vectors),
+                                          np.empty(max(len(vectors), 1024), np.float32)])
+            index.ids = data["ids"].tolist()
+            index.deleted = set(data["deleted"].tolist())
+            flat_links = data["links"].tolist()
+            counts = iter(data["counts"].tolist())
+            position = 0
+            for levels in data["levels"].tolist():
+                node_links = []
+                for _ in range(levels):
+                    count = next(counts)
+                    node_links.append(flat_links[position:position + count])
+                    position += count
+                index.links.append(node_links)
+        index.node_of = {item_id: node for node, item_id in enumerate(index.ids) if node not in index.deleted}
+        index.entry_point = None if entry_point < 0 else entry_point
+        index.max_level = max_level
+        return index
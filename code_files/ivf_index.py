@@ -0,0 +1,91 @@
+"""
+K-means training and centroid assignment for inverted-file (IVF) vector tables.
+
+An IVF table splits its vectors into n_lists partitions, one per k-means centroid. A query only scans
+the nprobe partitions whose centroids are nearest to it, so it reads about nprobe / n_lists of the
+table, at the cost of missing neighbours that landed in a partition it didn't probe.
+See create_ivf_vector_table in 06_sqlite_vec.py for the sqlite-vec side.
+"""
+
+from typing import Optional
+import numpy as np
+
+
+def squared_distances(vectors: np.ndarray, centroids: np.ndarray,
+                      centroid_norms: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    :return: the (len(vectors), len(centroids)) matrix of squared L2 distances
+    """
+    if centroid_norms is None:
+        centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    distances = vectors @ centroids.T
+    distances *= -2
+    distances += centroid_norms[None, :]
+    distances += np.einsum("ij,ij->i", vectors, vectors)[:, None]
+    return np.maximum(distances, 0, out=distances)
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, n: int = 1,
+                      block_size: int = 65_536) -> np.ndarray:
+    """
+    :return: the indices of the n nearest centroids of each vector, nearest first, shape (len(vectors), n)
+    """
+    vectors = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+    n = min(n, len(centroids))
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    nearest = np.empty((len(vectors), n), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        distances = squared_distances(vectors[start:start + block_size], centroids, centroid_norms)
+        if n == 1:
+            nearest[start:start + block_size, 0] = distances.argmin(axis=1)
+            continue
+        top = np.argpartition(distances, n - 1, axis=1)[:, :n]
+        order = np.argsort(np.take_along_axis(distances, top, axis=1), axis=1)
+        nearest[start:start + block_size] = np.take_along_axis(top, order, axis=1)
+    return nearest
+
+
+def train_kmeans(sample: np.ndarray, n_lists: int, iterations: int = 20, seed: int = 0,
+                 tolerance: float = 1e-4) -> np.ndarray:
+    """
+    Lloyd's k-means with k-means++ seeding
+    :param sample: training vectors; a few dozen per list is plenty, e.g. 50 * n_lists rows
+    :return: float32 centroids of shape (n_lists, dimensions)
+    """
+    sample = np.ascontiguousarray(np.atleast_2d(sample), dtype=np.float32)
+    if len(sample) < n_lists:
+        raise ValueError(f"Need at least {n_lists} sample vectors to train {n_lists} lists, got {len(sample)}")
+    rng = np.random.default_rng(seed)
+
+    # k-means++: each new centroid is drawn with probability proportional to its squared distance
+    # from the nearest centroid so far, which spreads the starting centroids out
+    centroids = np.empty((n_lists, sample.shape[1]), dtype=np.float32)
+    centroids[0] = sample[rng.integers(len(sample))]
+    closest = squared_distances(sample, centroids[:1])[:, 0]
+    for i in range(1, n_lists):
+        total = closest.sum()
+        choice = rng.choice(len(sample), p=closest / total) if total > 0 else rng.integers(len(sample))
+        centroids[i] = sample[choice]
+        np.minimum(closest, squared_distances(sample, centroids[i:i + 1])[:, 0], out=closest)
+
+    previous_cost = np.inf
+    for _ in range(iterations):
+        distances = squared_distances(sample, centroids)
+        labels = distances.argmin(axis=1)
+        cost = distances[np.arange(len(sample)), labels].sum()
+
+        counts = np.bincount(labels, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # an empty list takes over the sample vector that is currently worst served
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            worst = np.argsort(distances[np.arange(len(sample)), labels])[::-1][:len(empty)]
+            centroids[empty] = sample[worst]
+
+        if previous_cost - cost <= tolerance * cost:
+            break
+        previous_cost = cost
+    return centroids
@@ -0,0 +1,367 @@
+"""
+Retrieval over the knowledge-base/ folder for the RAG-without-a-vector-DB notebook (03_RAG_wo_vdb.ipynb).
+
+Two indexes answer a question without looking at every document:
+    EntityMatcher  an Aho-Corasick automaton over the names of employees, products, contracts and clients,
+                   taken from the file names; one pass over the question finds every name in it
+    BM25Index      an inverted index over the document bodies, stored as flat NumPy arrays, so scoring
+                   a query only touches the postings of its own terms
+
+Document bodies are read from disk only when they are returned, through a small LRU cache,
+and the BM25 index is saved next to the knowledge base and reused until a file changes.
+
+    knowledge_base = KnowledgeBase.open("knowledge-base")
+    knowledge_base.relevant_context("Who is Avery and what is Carllm?")
+"""
+
+import os
+import re
+import math
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# words too common to say anything about a document; skipping them keeps the longest postings lists out of queries
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from had has have he her his how i in is it its me my "
+    "of on or our she so that the their them they this to was we were what when where which who whom "
+    "why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class EntityMatcher:
+    """
+    Aho-Corasick over word tokens rather than characters: a name only matches whole words,
+    so "Chen" doesn't match inside "kitchen", and the automaton has one node per distinct word
+    prefix of the names, which keeps it small with a hundred thousand names
+    """
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # output[node] holds (length in tokens, name) for every name that ends at node
+        self.output: List[List[Tuple[int, str]]] = [[]]
+        self.values: Dict[str, List[str]] = {}
+        self._built = True
+
+    def add(self, name: str, value: str) -> None:
+        """
+        Map name to value; a name can map to several values, e.g. a first name shared by two employees
+        """
+        tokens = tokenize(name)
+        if not tokens:
+            return
+        key = " ".join(tokens)
+        if key not in self.values:
+            node = 0
+            for token in tokens:
+                next_node = self.goto[node].get(token)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][token] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = next_node
+            self.output[node].append((len(tokens), key))
+            self.values[key] = []
+        if value not in self.values[key]:
+            self.values[key].append(value)
+        self._built = False
+
+    def build(self) -> None:
+        """
+        Compute the failure links breadth first; each node also takes over the output of its failure
+        node, so a match of a name that ends inside a longer one is reported too
+        """
+        queue = list(self.goto[0].values())
+        for node in queue:
+            self.fail[node] = 0
+        for node in queue:
+            for token, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(token, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+        self._built = True
+
+    def find(self, text: str) -> List[str]:
+        """
+        :return: the values of the names in text, in order of appearance, without repeats;
+        where names overlap, the leftmost longest one wins, so "Alex Chen" doesn't also match "Chen"
+        """
+        if not self._built:
+            self.build()
+        matches = []
+        node = 0
+        for position, token in enumerate(tokenize(text)):
+            while node and token not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(token, 0)
+            for length, key in self.output[node]:
+                matches.append((position - length + 1, -length, key))
+
+        values: Dict[str, None] = {}
+        covered_until = 0
+        for start, negative_length, key in sorted(matches):
+            if start < covered_until:
+                continue
+            covered_until = start - negative_length
+            values.update(dict.fromkeys(self.values[key]))
+        return list(values)
+
+
+class BM25Index:
+    """
+    Okapi BM25 with the postings of all terms in flat arrays (compressed sparse rows):
+    the postings of term t are postings[offsets[t]:offsets[t + 1]], sorted by document, with their
+    precomputed term weights in weights and their order by weight in impacts, so a query reads a few
+    array slices instead of looping over documents
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+        self.weights = np.empty(0, dtype=np.float32)
+        # positions within each term's postings, ordered by weight, largest first
+        self.impacts = np.empty(0, dtype=np.int32)
+        self.document_count = 0
+
+    @classmethod
+    def build(cls, documents: Iterable[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """
+        :param documents: the document bodies; the n-th one is document n
+        """
+        index = cls(k1, b)
+        term_postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths = []
+        for document, text in enumerate(documents):
+            counts = Counter(token for token in tokenize(text) if token not in STOPWORDS)
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                term_postings.setdefault(term, []).append((document, count))
+
+        index.document_count = len(lengths)
+        lengths = np.asarray(lengths, dtype=np.float32)
+        # the length normalisation of each document, the same for every term in it
+        normalisation = k1 * (1 - b + b * lengths / max(float(lengths.mean()) if len(lengths) else 0.0, 1.0))
+        index.terms = {term: i for i, term in enumerate(term_postings)}
+        sizes = [len(postings) for postings in term_postings.values()]
+        index.offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+        index.postings = np.empty(index.offsets[-1], dtype=np.int32)
+        index.weights = np.empty(index.offsets[-1], dtype=np.float32)
+        index.impacts = np.empty(index.offsets[-1], dtype=np.int32)
+        for i, postings in enumerate(term_postings.values()):
+            documents_of_term, counts = np.asarray(postings, dtype=np.int64).T
+            idf = math.log((index.document_count - len(postings) + 0.5) / (len(postings) + 0.5) + 1)
+            start, stop = index.offsets[i], index.offsets[i + 1]
+            index.postings[start:stop] = documents_of_term
+            index.weights[start:stop] = idf * counts * (k1 + 1) / (counts + normalisation[documents_of_term])
+            index.impacts[start:stop] = np.argsort(-index.weights[start:stop], kind="stable")
+        return index
+
+    def _score(self, candidates: np.ndarray, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+        """
+        :return: the exact scores of candidates, looked up by binary search in each term's postings
+        """
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for start, stop in zip(starts, stops):
+            positions = start + np.searchsorted(self.postings[start:stop], candidates)
+            hits = positions < stop
+            hits[hits] = self.postings[positions[hits]] == candidates[hits]
+            scores[hits] += self.weights[positions[hits]]
+        return scores
+
+    def search(self, query: str, k: int = 3, depth: int = 256) -> List[Tuple[int, float]]:
+        """
+        Fagin's threshold algorithm over the impact-ordered postings: the documents among the top depth
+        postings of any query term are scored exactly; a document outside them can score at most the sum of
+        each term's next weight, so once the k-th best candidate reaches that bound, the top k are final.
+        Otherwise depth grows, and a query with no strong terms ends up scoring every posting
+        :return: up to k (document, score) pairs, best first; documents that share no term with the query are left out
+        """
+        terms = {self.terms[token] for token in tokenize(query) if token not in STOPWORDS and token in self.terms}
+        if not terms:
+            return []
+        terms = np.fromiter(terms, dtype=np.int64)
+        starts, stops = self.offsets[terms], self.offsets[terms + 1]
+        longest = int((stops - starts).max())
+        while depth < longest and depth * len(terms) < self.document_count // 16:
+            # impacts[start:stop] orders the postings of a term by weight, largest first
+            tops = [self.postings[start + self.impacts[start:min(start + depth, stop)]]
+                    for start, stop in zip(starts, stops)]
+            unseen = sum(float(self.weights[start + self.impacts[start + depth]])
+                         for start, stop in zip(starts, stops) if stop - start > depth)
+            candidates = np.unique(np.concatenate(tops))
+            scores = self._score(candidates, starts, stops)
+            if len(candidates) >= k and np.partition(scores, -k)[-k] >= unseen:
+                return self._top(candidates, scores, k)
+            depth *= 4
+
+        scores = np.zeros(self.document_count, dtype=np.float32)
+        for start, stop in zip(starts, stops):
+            # a document appears once in a term's postings, so a fancy-indexed += adds every weight
+            scores[self.postings[start:stop]] += self.weights[start:stop]
+        candidates = np.flatnonzero(scores)
+        return self._top(candidates, scores[candidates], k)
+
+    @staticmethod
+    def _top(candidates: np.ndarray, scores: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        if len(candidates) > k:
+            top = np.argpartition(scores, -k)[-k:]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(int(document), float(score)) for document, score in zip(candidates[order], scores[order])]
+
+    def save(self, path: str, **extra: np.ndarray) -> None:
+        """
+        Write the index to one .npz file, with any extra arrays stored alongside it
+        """
+        np.savez(
+            path,
+            settings=np.array([self.k1, self.b, self.document_count], dtype=np.float64),
+            terms=np.array(list(self.terms), dtype=str),
+            offsets=self.offsets,
+            postings=self.postings,
+            weights=self.weights,
+            impacts=self.impacts,
+            **extra,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> Tuple["BM25Index", Dict[str, np.ndarray]]:
+        """
+        :return: the index and the extra arrays it was saved with
+        """
+        with np.load(path) as data:
+            k1, b, document_count = data["settings"].tolist()
+            index = cls(k1, b)
+            index.document_count = int(document_count)
+            index.terms = {term: i for i, term in enumerate(data["terms"].tolist())}
+            index.offsets = data["offsets"]
+            index.postings = data["postings"]
+            index.weights = data["weights"]
+            index.impacts = data["impacts"]
+            extra = {name: data[name] for name in data.files
+                     if name not in ("settings", "terms", "offsets", "postings", "weights", "impacts")}
+        return index, extra
+
+
+def employee_aliases(stem: str) -> List[str]:
+    # "Avery Lancaster" is found by the full name, the last name (the notebook's original key) or the first name
+    parts = stem.split()
+    return [stem, parts[-1], parts[0]] if len(parts) > 1 else [stem]
+
+
+def contract_aliases(stem: str) -> List[str]:
+    # "Contract with Apex Reinsurance for Rellm" is also found by the client's name
+    match = re.match(r"Contract with (.+) for (.+)", stem)
+    return [stem, match.group(1)] if match else [stem]
+
+
+def default_aliases(stem: str) -> List[str]:
+    # a capitalised file name is taken to be a name; "about" or "careers" would match far too many questions
+    return [stem] if stem[:1].isupper() else []
+
+
+# how each folder of the knowledge base names its documents
+ALIASES: Dict[str, Callable[[str], List[str]]] = {
+    "employees": employee_aliases,
+    "contracts": contract_aliases,
+}
+
+
+class KnowledgeBase:
+    def __init__(self, root: str, paths: Sequence[str], index: BM25Index, cache_size: int = 256):
+        """
+        Use KnowledgeBase.open, which builds or loads the BM25 index
+        :param paths: the documents, relative to root, in the order the index numbers them
+        :param cache_size: how many document bodies to keep in memory
+        """
+        self.root = root
+        self.paths = list(paths)
+        self.index = index
+        self.matcher = EntityMatcher()
+        for document, path in enumerate(self.paths):
+            folder, name = os.path.split(path)
+            stem = os.path.splitext(name)[0]
+            for alias in ALIASES.get(os.path.basename(folder), default_aliases)(stem):
+                self.matcher.add(alias, str(document))
+        self.matcher.build()
+        self.document = lru_cache(maxsize=cache_size)(self._read)
+
+    @staticmethod
+    def scan(root: str) -> List[Tuple[str, int, int]]:
+        """
+        :return: (path relative to root, mtime in ns, size) of every Markdown file, sorted by path
+        """
+        files = []
+        for directory, _, names in os.walk(root):
+            for name in names:
+                if name.endswith(".md"):
+                    path = os.path.join(directory, name)
+                    stat = os.stat(path)
+                    files.append((os.path.relpath(path, root), stat.st_mtime_ns, stat.st_size))
+        return sorted(files)
+
+    @classmethod
+    def open(cls, root: str = "knowledge-base", index_path: Optional[str] = None,
+             cache_size: int = 256) -> "KnowledgeBase":
+        """
+        Load the saved index if no file was added, removed or changed since it was built, or build and save it
+        :param index_path: defaults to .bm25.npz inside root
+        """
+        index_path = index_path or os.path.join(root, ".bm25.npz")
+        files = cls.scan(root)
+        paths = [path for path, _, _ in files]
+        stamps = np.array([(mtime, size) for _, mtime, size in files], dtype=np.int64).reshape(-1, 2)
+        if os.path.exists(index_path):
+            index, extra = BM25Index.load(index_path)
+            if extra["paths"].tolist() == paths and np.array_equal(extra["stamps"], stamps):
+                return cls(root, paths, index, cache_size)
+
+        def bodies():
+            for path in paths:
+                with open(os.path.join(root, path), encoding="utf-8") as file:
+                    yield file.read()
+
+        index = BM25Index.build(bodies())
+        index.save(index_path, paths=np.array(paths, dtype=str), stamps=stamps)
+        return cls(root, paths, index, cache_size)
+
+    def _read(self, document: int) -> str:
+        with open(os.path.join(self.root, self.paths[document]), encoding="utf-8") as file:
+            return file.read()
+
+    def search(self, message: str, limit: int = 3) -> List[int]:
+        """
+        :return: the documents named in message, then the best BM25 matches, up to limit documents in all;
+        named documents are always returned, even past limit
+        """
+        documents = [int(document) for document in self.matcher.find(message)]
+        if len(documents) < limit:
+            named = set(documents)
+            for document, _ in self.index.search(message, limit + len(named)):
+                if document not in named:
+                    documents.append(document)
+                    if len(documents) == limit:
+                        break
+        return documents
+
+    def relevant_context(self, message: str, limit: int = 3) -> List[str]:
+        """
+        :return: the bodies of the documents search() finds for message
+        """
+        return [self.document(document) for document in self.search(message, limit)]